@@ -0,0 +1,347 @@
+"""Local stand-ins for the services the backend calls: Gemini, Firestore and YouTube search.
+
+Each fake adds a configurable latency so the benchmark measures the backend's own overhead
+on top of realistic upstream round trips, without credentials or network access.
+"""
+
+import asyncio
+import copy
+import hashlib
+import json
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+from uuid import uuid4
+
+from google.api_core.exceptions import AlreadyExists
+from google.cloud.firestore_v1 import transforms
+
+
+def _delay(latency_ms: float, jitter_ms: float) -> float:
+    return max(0.0, latency_ms + random.uniform(-jitter_ms, jitter_ms)) / 1000
+
+
+# ─── Gemini ──────────────────────────────────────────────────────────────────
+
+DEFAULT_INGREDIENTS = ["tomato", "egg", "spinach", "onion", "garlic", "feta"]
+
+
+def default_payload(recipes: int, ingredients: list[str] = DEFAULT_INGREDIENTS) -> dict:
+    """A well-formed model response with ``recipes`` recipes built from ``ingredients``."""
+    items = [
+        {
+            "name": f"Bench Recipe {i + 1}",
+            "description": "A quick dish generated for benchmarking.",
+            "servings": "2",
+            "ingredients_used": [f"1 cup {name}" for name in ingredients[:4]],
+            "additional_ingredients": ["salt", "olive oil"],
+            "instructions": [f"Step {step + 1}: prepare and cook the ingredients." for step in range(6)],
+            "nutrition": {"calories_kcal": 420, "protein_g": 24, "carbs_g": 30, "fat_g": 18},
+            "health_score": 8,
+            "health_explanation": "Balanced macros and plenty of vegetables.",
+            "diet_tags": ["vegetarian", "high-protein"],
+            "estimated_time_minutes": 25,
+            "youtube_query": f"how to make bench recipe {i + 1}",
+        }
+        for i in range(recipes)
+    ]
+    return {"detected_ingredients": ingredients, "recipes": items, "ranking": [item["name"] for item in items]}
+
+
+class FakeModels:
+    """``client.aio.models``: answers detection calls with the payload's ingredients and
+    recipe calls with its recipes, after the configured latency."""
+
+    def __init__(self, payload: dict, latency_ms: float, jitter_ms: float, detection_latency_ms: float, stream_chunks: int = 8):
+        self.payload = payload
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.detection_latency_ms = detection_latency_ms
+        self.stream_chunks = max(1, stream_chunks)
+        self.calls = 0
+
+    def _is_detection(self, config) -> bool:
+        schema = getattr(config, "response_schema", None)
+        return getattr(schema, "__name__", "") == "IngredientDetection"
+
+    def _text(self, config) -> str:
+        if self._is_detection(config):
+            return json.dumps({"detected_ingredients": self.payload["detected_ingredients"]})
+        return json.dumps({key: self.payload[key] for key in ("recipes", "ranking")})
+
+    async def generate_content(self, model, contents, config=None):
+        self.calls += 1
+        latency_ms = self.detection_latency_ms if self._is_detection(config) else self.latency_ms
+        await asyncio.sleep(_delay(latency_ms, self.jitter_ms))
+        return SimpleNamespace(text=self._text(config), parsed=None, usage_metadata=None)
+
+    async def generate_content_stream(self, model, contents, config=None):
+        self.calls += 1
+        text = self._text(config)
+        size = -(-len(text) // self.stream_chunks)
+        step = _delay(self.latency_ms, self.jitter_ms) / self.stream_chunks
+
+        async def chunks():
+            for start in range(0, len(text), size):
+                await asyncio.sleep(step)
+                yield SimpleNamespace(text=text[start:start + size])
+
+        return chunks()
+
+
+class FakeGenaiClient:
+    def __init__(self, models: FakeModels):
+        self.aio = SimpleNamespace(models=models)
+        self.models = None
+
+
+# ─── Firestore ───────────────────────────────────────────────────────────────
+
+def _apply(value, current):
+    """Resolve server-side transforms against the stored value."""
+    if value is transforms.SERVER_TIMESTAMP:
+        return datetime.now(timezone.utc)
+    if isinstance(value, transforms.Increment):
+        return (current if isinstance(current, (int, float)) else 0) + value.value
+    if isinstance(value, dict):
+        base = current if isinstance(current, dict) else {}
+        return {key: _apply(item, base.get(key)) for key, item in value.items()}
+    return copy.deepcopy(value)
+
+
+def _merge(current: dict, data: dict) -> dict:
+    merged = dict(current)
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _merge(merged[key], value)
+        else:
+            merged[key] = _apply(value, merged.get(key))
+    return merged
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data: dict | None, fields: list[str] | None = None):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        if data is not None and fields is not None:
+            data = {field: data[field] for field in fields if field in data}
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+
+class FakeQuery:
+    _OPS = {
+        "==": lambda a, b: a == b,
+        "<": lambda a, b: a < b,
+        "<=": lambda a, b: a <= b,
+        ">": lambda a, b: a > b,
+        ">=": lambda a, b: a >= b,
+    }
+
+    def __init__(self, client, path: str, filters=(), orders=(), fields=None, after=None, limit=None):
+        self._client = client
+        self._path = path
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._fields = fields
+        self._after = after
+        self._limit = limit
+
+    def _copy(self, **changes):
+        state = {
+            "filters": self._filters, "orders": self._orders, "fields": self._fields,
+            "after": self._after, "limit": self._limit, **changes,
+        }
+        return FakeQuery(self._client, self._path, **state)
+
+    def where(self, field, op, value):
+        return self._copy(filters=self._filters + ((field, op, value),))
+
+    def order_by(self, field, direction="ASCENDING"):
+        return self._copy(orders=self._orders + ((field, direction == "DESCENDING"),))
+
+    def select(self, fields):
+        return self._copy(fields=list(fields))
+
+    def start_after(self, snapshot_or_values):
+        # A snapshot resumes after that document; a dict resumes after those order-by values.
+        if isinstance(snapshot_or_values, dict):
+            return self._copy(after=dict(snapshot_or_values))
+        return self._copy(after=snapshot_or_values.id)
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def _matches(self) -> list[tuple[str, dict]]:
+        docs = list(self._client._collection(self._path).items())
+        for field, op, value in self._filters:
+            docs = [(doc_id, data) for doc_id, data in docs if field in data and self._OPS[op](data[field], value)]
+        for field, descending in reversed(self._orders):
+            docs = [(doc_id, data) for doc_id, data in docs if field in data]
+            docs.sort(key=lambda item: item[1][field], reverse=descending)
+        if isinstance(self._after, dict):
+            field, descending = self._orders[0]
+            value = self._after[field]
+            docs = [(doc_id, data) for doc_id, data in docs if (data[field] < value if descending else data[field] > value)]
+        elif self._after is not None:
+            ids = [doc_id for doc_id, _ in docs]
+            docs = docs[ids.index(self._after) + 1:] if self._after in ids else []
+        return docs[:self._limit] if self._limit is not None else docs
+
+    async def stream(self):
+        await self._client._round_trip()
+        for doc_id, data in self._matches():
+            yield FakeSnapshot(FakeDocument(self._client, f"{self._path}/{doc_id}"), data, self._fields)
+
+    async def get(self):
+        return [snapshot async for snapshot in self.stream()]
+
+
+class FakeCollection(FakeQuery):
+    def document(self, doc_id: str | None = None):
+        return FakeDocument(self._client, f"{self._path}/{doc_id or uuid4().hex[:20]}")
+
+
+class FakeDocument:
+    def __init__(self, client, path: str):
+        self._client = client
+        self.path = path
+        self._parent, self.id = path.rsplit("/", 1)
+
+    def collection(self, name: str):
+        return FakeCollection(self._client, f"{self.path}/{name}")
+
+    def _read(self) -> dict | None:
+        return self._client._collection(self._parent).get(self.id)
+
+    def _write(self, data: dict, merge: bool = False) -> None:
+        docs = self._client._collection(self._parent)
+        current = docs.get(self.id) or {}
+        docs[self.id] = _merge(current, data) if merge else _apply(data, {})
+
+    def _create(self, data: dict) -> None:
+        if self._read() is not None:
+            raise AlreadyExists(f"Document already exists: {self.path}")
+        self._write(data)
+
+    def _delete(self) -> None:
+        self._client._collection(self._parent).pop(self.id, None)
+
+    async def get(self):
+        await self._client._round_trip()
+        return FakeSnapshot(self, self._read())
+
+    async def set(self, data: dict, merge: bool = False):
+        await self._client._round_trip()
+        self._write(data, merge)
+
+    async def create(self, data: dict):
+        await self._client._round_trip()
+        self._create(data)
+
+    async def delete(self):
+        await self._client._round_trip()
+        self._delete()
+
+
+class FakeBatch:
+    def __init__(self, client):
+        self._client = client
+        self._ops = []
+
+    def set(self, reference, data, merge=False):
+        self._ops.append(lambda: reference._write(data, merge))
+
+    def create(self, reference, data):
+        self._ops.append(lambda: reference._create(data))
+
+    def delete(self, reference):
+        self._ops.append(reference._delete)
+
+    async def commit(self):
+        await self._client._round_trip()
+        for op in self._ops:
+            op()
+
+
+class FakeFirestore:
+    """In-memory async Firestore covering the calls ``UserRepository`` makes. Every RPC
+    (get, set, commit, stream, get_all) costs one simulated round trip."""
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self._collections: dict[str, dict[str, dict]] = {}
+        self.round_trips = 0
+
+    def _collection(self, path: str) -> dict[str, dict]:
+        return self._collections.setdefault(path, {})
+
+    async def _round_trip(self) -> None:
+        self.round_trips += 1
+        if self.latency_ms or self.jitter_ms:
+            await asyncio.sleep(_delay(self.latency_ms, self.jitter_ms))
+
+    def collection(self, name: str):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+    async def get_all(self, references, field_paths=None):
+        await self._round_trip()
+        for reference in references:
+            yield FakeSnapshot(reference, reference._read(), field_paths)
+
+
+# ─── YouTube ─────────────────────────────────────────────────────────────────
+
+class FakeYouTubeServer:
+    """Threaded HTTP server answering ``/results?search_query=...`` with a results page that
+    holds one stable video id per query."""
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query).get("search_query", [""])[0]
+                time.sleep(_delay(server.latency_ms, server.jitter_ms))
+                video_id = hashlib.sha256(query.encode("utf-8")).hexdigest()[:11]
+                body = f'<html><a href="/watch?v={video_id}">{query}</a></html>'.encode("utf-8")
+                server.requests += 1
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.requests = 0
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/results"
+
+    def start(self) -> "FakeYouTubeServer":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
@@ -0,0 +1,347 @@
+"""Offline load benchmark for the NutriSnap backend.
+
+Serves ``main.app`` with uvicorn on a local port, with Gemini, Firestore and YouTube replaced
+by the stand-ins in ``benchmarks.fakes``, then drives concurrent requests against the analysis
+and CRUD endpoints and reports throughput and p50/p95/p99 latency per endpoint.
+
+    cd backend
+    python -m benchmarks.run --requests 200 --concurrency 16
+    python -m benchmarks.run --save baseline.json
+    python -m benchmarks.run --compare baseline.json --tolerance 0.2
+
+``--firestore`` picks the data layer: ``memory`` (in-memory fake, default), ``local`` (the
+SQLite fallback store, as during a Firestore outage) or ``emulator`` (the Firestore emulator at
+``FIRESTORE_EMULATOR_HOST``). ID-token checks are replaced by ``Bearer bench-<uid>`` tokens.
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from unittest import mock
+
+import httpx
+
+from benchmarks.fakes import FakeFirestore, FakeGenaiClient, FakeModels, FakeYouTubeServer, default_payload
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+
+# ─── App Under Test ──────────────────────────────────────────────────────────
+
+def load_app(args, models: FakeModels, youtube: FakeYouTubeServer):
+    """Import ``main`` wired to the fakes. Must run before anything else imports ``main``."""
+    os.environ["YOUTUBE_SEARCH_URL"] = youtube.url
+    os.environ.setdefault("GCP_PROJECT_ID", "nutrisnap-bench")
+    os.environ.setdefault("YOUTUBE_CACHE_DISK", "0")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("RATE_LIMIT_ENABLED", "0")
+    os.environ.pop("REDIS_URL", None)
+
+    import firebase_admin
+    from firebase_admin import credentials
+    from google import genai
+    from google.auth.credentials import AnonymousCredentials
+
+    class BenchCredential(credentials.Base):
+        def get_credential(self):
+            return AnonymousCredentials()
+
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(BenchCredential(), {"projectId": os.environ["GCP_PROJECT_ID"]})
+
+    sys.path.insert(0, str(BACKEND_DIR))
+    with mock.patch.object(genai, "Client", lambda *a, **k: FakeGenaiClient(models)):
+        import main
+
+    data_dir = Path(tempfile.mkdtemp(prefix="nutrisnap-bench-"))
+    main.local_store = main.LocalUserStore(data_dir / "user_store.sqlite3")
+    main.local_reconciler.store = main.local_store
+
+    if args.firestore == "memory":
+        main.db = FakeFirestore(args.firestore_latency_ms, args.firestore_jitter_ms)
+    elif args.firestore == "local":
+        main.firestore_breaker.state = "open"
+        main.firestore_breaker.reset_timeout = float("inf")
+    elif not os.getenv("FIRESTORE_EMULATOR_HOST"):
+        raise SystemExit("--firestore emulator needs FIRESTORE_EMULATOR_HOST (e.g. localhost:8080)")
+    else:
+        from google.cloud import firestore as cloud_firestore
+
+        main.db = cloud_firestore.AsyncClient(project=os.environ["GCP_PROJECT_ID"], credentials=AnonymousCredentials())
+
+    async def verify(token: str) -> str | None:
+        return token.removeprefix("bench-") if token.startswith("bench-") else None
+
+    async def no_refresh() -> None:
+        await asyncio.Event().wait()
+
+    main.id_token_verifier.verify = verify
+    main.id_token_verifier.run_refresh_loop = no_refresh
+    return main
+
+
+class ServerThread:
+    """uvicorn serving the app from a background thread, so the load generator's event loop
+    and the server's event loop do not compete."""
+
+    def __init__(self, app):
+        import uvicorn
+
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            self.port = probe.getsockname()[1]
+        config = uvicorn.Config(app, host="127.0.0.1", port=self.port, log_level="warning", lifespan="on")
+        self.server = uvicorn.Server(config)
+        self._thread = threading.Thread(target=self.server.run, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def __enter__(self) -> "ServerThread":
+        self._thread.start()
+        while not self.server.started:
+            if not self._thread.is_alive():
+                raise RuntimeError("Benchmark server failed to start")
+            time.sleep(0.05)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.server.should_exit = True
+        self._thread.join(timeout=15)
+
+
+# ─── Workload ────────────────────────────────────────────────────────────────
+
+def make_images(count: int, size: tuple[int, int] = (960, 720)) -> list[bytes]:
+    """Distinct JPEG photos; each one is a cache miss the first time it is analyzed."""
+    from PIL import Image
+
+    rng = random.Random(7)
+    images = []
+    for _ in range(count):
+        image = Image.new("RGB", size, tuple(rng.randrange(256) for _ in range(3)))
+        for _ in range(24):
+            x, y = rng.randrange(size[0]), rng.randrange(size[1])
+            block = Image.new("RGB", (rng.randrange(40, 200), rng.randrange(40, 200)), tuple(rng.randrange(256) for _ in range(3)))
+            image.paste(block, (x, y))
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=90)
+        images.append(buffer.getvalue())
+    return images
+
+
+@dataclass
+class Scenario:
+    name: str
+    method: str
+    # Builds (path, request kwargs) for the i-th request.
+    build: object
+    requests: int
+
+
+@dataclass
+class Result:
+    name: str
+    latencies: list[float] = field(default_factory=list)
+    errors: dict[str, int] = field(default_factory=dict)
+    elapsed: float = 0.0
+
+    def summary(self) -> dict:
+        ordered = sorted(self.latencies)
+        return {
+            "requests": len(ordered) + sum(self.errors.values()),
+            "errors": dict(self.errors),
+            "throughput_rps": round(len(ordered) / self.elapsed, 1) if self.elapsed else 0.0,
+            "p50_ms": percentile(ordered, 50),
+            "p95_ms": percentile(ordered, 95),
+            "p99_ms": percentile(ordered, 99),
+            "max_ms": round(ordered[-1] * 1000, 1) if ordered else None,
+        }
+
+
+def percentile(ordered: list[float], pct: float) -> float | None:
+    """Nearest-rank percentile of sorted latencies (seconds), in milliseconds."""
+    if not ordered:
+        return None
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return round(ordered[int(rank) - 1] * 1000, 1)
+
+
+def build_scenarios(args, images: list[bytes]) -> list[Scenario]:
+    payload_recipe = default_payload(1)["recipes"][0]
+
+    def user(i: int) -> str:
+        return f"bench-user-{i % args.users}"
+
+    def auth(i: int) -> dict:
+        return {"Authorization": f"Bearer {user(i)}"}
+
+    def analyze(i: int):
+        image = images[i % len(images)]
+        headers = auth(i) if i % 4 else {}  # every fourth request is a guest
+        return "/api/analyze-food", {"files": {"image": (f"meal-{i}.jpg", image, "image/jpeg")}, "headers": headers}
+
+    def save(i: int):
+        recipe = {**payload_recipe, "name": f"Bench Recipe {i % 25}"}
+        return "/api/saved-recipes", {"json": recipe, "headers": auth(i)}
+
+    def put_preferences(i: int):
+        prefs = {"diet_type": random.choice(["vegetarian", "vegan", "non-vegetarian"]), "has_onboarded": True}
+        return "/api/preferences", {"json": prefs, "headers": auth(i)}
+
+    def feedback(i: int):
+        body = {"recipe_name": f"Bench Recipe {i % 25}", "feedback_type": random.choice(["👍", "👍", "👎", "too_hard"])}
+        return "/api/feedback", {"json": body, "headers": auth(i)}
+
+    def get(path: str):
+        return lambda i: (path, {"headers": auth(i)})
+
+    scenarios = [
+        Scenario("POST /api/analyze-food", "POST", analyze, args.analyze_requests),
+        Scenario("PUT /api/preferences", "PUT", put_preferences, args.requests),
+        Scenario("GET /api/preferences", "GET", get("/api/preferences"), args.requests),
+        Scenario("POST /api/saved-recipes", "POST", save, args.requests),
+        Scenario("GET /api/saved-recipes", "GET", get("/api/saved-recipes"), args.requests),
+        Scenario("GET /api/food-history", "GET", get("/api/food-history"), args.requests),
+        Scenario("GET /api/bootstrap", "GET", get("/api/bootstrap"), args.requests),
+        Scenario("POST /api/feedback", "POST", feedback, args.requests),
+        Scenario("GET /api/feedback/popular", "GET", lambda i: ("/api/feedback/popular", {}), args.requests),
+    ]
+    if args.endpoints:
+        wanted = [name.strip() for name in args.endpoints.split(",")]
+        scenarios = [s for s in scenarios if any(w in s.name for w in wanted)]
+    return scenarios
+
+
+async def run_scenario(http: httpx.AsyncClient, scenario: Scenario, concurrency: int) -> Result:
+    result = Result(scenario.name)
+    next_index = iter(range(scenario.requests))
+
+    async def worker():
+        for i in next_index:
+            path, kwargs = scenario.build(i)
+            started = time.perf_counter()
+            try:
+                response = await http.request(scenario.method, path, **kwargs)
+            except httpx.HTTPError as e:
+                key = type(e).__name__
+            else:
+                if response.status_code < 400:
+                    result.latencies.append(time.perf_counter() - started)
+                    continue
+                key = str(response.status_code)
+            result.errors[key] = result.errors.get(key, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    result.elapsed = time.perf_counter() - started
+    return result
+
+
+async def drive(base_url: str, scenarios: list[Scenario], concurrency: int) -> dict:
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=120, limits=limits) as http:
+        results = {}
+        for scenario in scenarios:
+            result = await run_scenario(http, scenario, concurrency)
+            results[scenario.name] = result.summary()
+            print(format_row(scenario.name, results[scenario.name]), flush=True)
+        return results
+
+
+# ─── Reporting ───────────────────────────────────────────────────────────────
+
+HEADER = f"{'endpoint':<30} {'reqs':>6} {'errors':>6} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}"
+
+
+def format_row(name: str, row: dict) -> str:
+    def cell(value) -> str:
+        return "-" if value is None else str(value)
+
+    errors = sum(row["errors"].values())
+    return (
+        f"{name:<30} {row['requests']:>6} {errors:>6} {row['throughput_rps']:>8} "
+        f"{cell(row['p50_ms']):>9} {cell(row['p95_ms']):>9} {cell(row['p99_ms']):>9} {cell(row['max_ms']):>9}"
+    )
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Endpoints whose p95 latency grew more than ``tolerance`` over the baseline, or which
+    now return errors."""
+    regressions = []
+    for name, row in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if sum(row["errors"].values()) > sum(before["errors"].values()):
+            regressions.append(f"{name}: errors {before['errors']} -> {row['errors']}")
+        if before["p95_ms"] and row["p95_ms"] and row["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {before['p95_ms']} ms -> {row['p95_ms']} ms")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=200, help="requests per CRUD endpoint")
+    parser.add_argument("--analyze-requests", type=int, default=60, help="requests to /api/analyze-food")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--users", type=int, default=20, help="distinct signed-in users")
+    parser.add_argument("--distinct-images", type=int, default=20, help="distinct photos; repeats hit the analysis cache")
+    parser.add_argument("--endpoints", help="comma-separated substrings selecting scenarios, e.g. 'analyze,bootstrap'")
+    parser.add_argument("--model-latency-ms", type=float, default=1200)
+    parser.add_argument("--detection-latency-ms", type=float, default=600)
+    parser.add_argument("--model-jitter-ms", type=float, default=200)
+    parser.add_argument("--recipes", type=int, default=3, help="recipes per model response")
+    parser.add_argument("--model-payload", type=Path, help="JSON file with detected_ingredients, recipes and ranking")
+    parser.add_argument("--firestore", choices=["memory", "local", "emulator"], default="memory")
+    parser.add_argument("--firestore-latency-ms", type=float, default=15)
+    parser.add_argument("--firestore-jitter-ms", type=float, default=5)
+    parser.add_argument("--youtube-latency-ms", type=float, default=250)
+    parser.add_argument("--youtube-jitter-ms", type=float, default=100)
+    parser.add_argument("--save", type=Path, help="write results as JSON")
+    parser.add_argument("--compare", type=Path, help="baseline JSON from --save; exit 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative p95 growth for --compare")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    random.seed(11)
+    payload = json.loads(args.model_payload.read_text()) if args.model_payload else default_payload(args.recipes)
+    models = FakeModels(payload, args.model_latency_ms, args.model_jitter_ms, args.detection_latency_ms)
+    youtube = FakeYouTubeServer(args.youtube_latency_ms, args.youtube_jitter_ms).start()
+    app_module = load_app(args, models, youtube)
+    scenarios = build_scenarios(args, make_images(max(1, args.distinct_images)))
+
+    print(f"firestore={args.firestore} concurrency={args.concurrency} model={args.model_latency_ms:g}ms youtube={args.youtube_latency_ms:g}ms")
+    print(HEADER)
+    try:
+        with ServerThread(app_module.app) as server:
+            results = asyncio.run(drive(server.url, scenarios, args.concurrency))
+    finally:
+        youtube.stop()
+    print(f"model calls: {models.calls}, youtube lookups: {youtube.requests}, counters: {dict(app_module.runtime_stats)}")
+
+    if args.save:
+        args.save.write_text(json.dumps(results, indent=2, ensure_ascii=False))
+    if args.compare:
+        regressions = compare(results, json.loads(args.compare.read_text()), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,24 @@
+"""Loads ``main`` once against the benchmark fakes (Gemini stub, in-memory Firestore, local
+YouTube server), so tests run offline and without credentials."""
+
+import pytest
+
+from benchmarks.fakes import FakeModels, FakeYouTubeServer, default_payload
+from benchmarks.run import load_app, parse_args
+
+
+@pytest.fixture(scope="session")
+def youtube():
+    server = FakeYouTubeServer().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture(scope="session")
+def models():
+    return FakeModels(default_payload(2), latency_ms=20, jitter_ms=0, detection_latency_ms=10)
+
+
+@pytest.fixture(scope="session")
+def main(models, youtube):
+    return load_app(parse_args(["--firestore-latency-ms", "0", "--firestore-jitter-ms", "0"]), models, youtube)
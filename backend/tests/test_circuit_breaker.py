@@ -0,0 +1,110 @@
+import asyncio
+
+import pytest
+
+
+def make_breaker(main, **kwargs):
+    closed = []
+    options = {"failure_threshold": 2, "reset_timeout": 0.05, "probe_timeout": 0.05, **kwargs}
+    breaker = main.CircuitBreaker("test", on_close=lambda: closed.append(True), **options)
+    return breaker, closed
+
+
+def test_opens_after_threshold_and_closes_on_successful_probe(main):
+    breaker, closed = make_breaker(main)
+    breaker.record_failure()
+    assert breaker.state == "closed" and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+
+    asyncio.run(asyncio.sleep(0.06))
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    assert not breaker.allow()  # one probe at a time
+    breaker.record_success()
+    assert breaker.state == "closed" and closed == [True]
+
+
+def test_failed_probe_reopens(main):
+    breaker, _ = make_breaker(main, failure_threshold=1)
+    breaker.record_failure()
+    asyncio.run(asyncio.sleep(0.06))
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+
+
+def test_unreported_probe_expires(main):
+    breaker, _ = make_breaker(main, failure_threshold=1)
+    breaker.record_failure()
+    asyncio.run(asyncio.sleep(0.06))
+    assert breaker.allow()  # probe handed out but never reports back
+    assert not breaker.allow()
+    asyncio.run(asyncio.sleep(0.06))
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+
+
+def open_repository(main):
+    breaker, _ = make_breaker(main, failure_threshold=1)
+    breaker.record_failure()
+    return main.UserRepository(lambda: None, breaker), breaker
+
+
+def test_cancelled_probe_reopens_breaker(main):
+    repository, breaker = open_repository(main)
+
+    async def scenario():
+        await asyncio.sleep(0.06)
+        probe = asyncio.create_task(repository._call(lambda: asyncio.sleep(10), lambda: "local"))
+        await asyncio.sleep(0.01)
+        assert breaker.state == "half_open"
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+
+    asyncio.run(scenario())
+    assert breaker.state == "open"
+
+
+def test_hung_probe_times_out_to_local_fallback(main):
+    repository, breaker = open_repository(main)
+
+    async def scenario():
+        await asyncio.sleep(0.06)
+        return await repository._call(lambda: asyncio.sleep(10), lambda: "local")
+
+    assert asyncio.run(scenario()) == "local"
+    assert breaker.state == "open"
+
+
+def test_unavailable_errors_fall_back_and_open(main):
+    breaker, _ = make_breaker(main, failure_threshold=1)
+    repository = main.UserRepository(lambda: None, breaker)
+
+    async def remote():
+        raise main.GoogleServiceUnavailable("down")
+
+    assert asyncio.run(repository._call(remote, lambda: "local")) == "local"
+    assert breaker.state == "open"
+    assert asyncio.run(repository._call(remote, lambda: "short-circuited")) == "short-circuited"
+    with pytest.raises(main.FirestoreCircuitOpen):
+        asyncio.run(repository._call(remote))
+
+
+def test_probe_hitting_other_error_does_not_close(main):
+    breaker, _ = make_breaker(main, failure_threshold=1, probe_timeout=5)
+    breaker.record_failure()
+    repository = main.UserRepository(lambda: None, breaker)
+
+    async def remote():
+        raise ValueError("bad query")
+
+    async def scenario():
+        await asyncio.sleep(0.06)
+        with pytest.raises(ValueError):
+            await repository._call(remote, lambda: "local")
+
+    asyncio.run(scenario())
+    assert breaker.state == "half_open"
+    assert not breaker.allow()  # the next probe waits for probe_timeout as usual
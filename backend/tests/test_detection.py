@@ -0,0 +1,41 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+
+def detection_stub(models, monkeypatch, text):
+    calls = []
+
+    async def generate_content(model, contents, config=None):
+        calls.append(model)
+        return SimpleNamespace(text=text, parsed=None, usage_metadata=None)
+
+    monkeypatch.setattr(models, "generate_content", generate_content)
+    return calls
+
+
+def test_insufficient_detection_is_not_cached(main, models, monkeypatch):
+    calls = detection_stub(models, monkeypatch, json.dumps({"detected_ingredients": ["tomato"]}))
+    for _ in range(2):
+        with pytest.raises(HTTPException) as error:
+            asyncio.run(main.detect_ingredients("one-ingredient", b"img", "image/jpeg"))
+        assert error.value.status_code == 400
+    assert len(calls) == 2
+    assert main.detection_cache.get("one-ingredient") is None
+
+
+def test_salvaged_detection_is_served_but_not_cached(main, models, monkeypatch):
+    detection_stub(models, monkeypatch, '{"detected_ingredients": ["tomato", "egg", "spin')
+    ingredients = asyncio.run(main.detect_ingredients("salvaged", b"img", "image/jpeg"))
+    assert ingredients[:2] == ["tomato", "egg"]
+    assert main.detection_cache.get("salvaged") is None
+
+
+def test_complete_detection_is_cached(main, models, monkeypatch):
+    calls = detection_stub(models, monkeypatch, json.dumps({"detected_ingredients": ["tomato", "egg"]}))
+    for _ in range(2):
+        assert asyncio.run(main.detect_ingredients("complete", b"img", "image/jpeg")) == ["tomato", "egg"]
+    assert len(calls) == 1
@@ -0,0 +1,29 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+
+def shard_counts(main, recipe_name):
+    prefix = f"recipe_feedback/{main.feedback_counter_key(recipe_name)}/shards"
+    fields = set()
+    for path, documents in main.db._collections.items():
+        if path == prefix:
+            for document in documents.values():
+                fields.update(document.get("counts", {}))
+    return fields
+
+
+def test_unknown_feedback_type_creates_no_counter_field(main):
+    writes = [
+        ("feedback", "fb-user", {"recipe_name": "Dal Tadka", "feedback_type": "👍"}),
+        ("feedback", "fb-user", {"recipe_name": "Dal Tadka", "feedback_type": "x" * 20}),
+    ]
+    asyncio.run(main.user_repository.append_entries(writes))
+    assert shard_counts(main, "Dal Tadka") == {"👍"}
+
+
+def test_unknown_feedback_type_is_rejected(main):
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(main.submit_feedback({"recipe_name": "Dal Tadka", "feedback_type": "spam-1"}, uid="fb-user"))
+    assert error.value.status_code == 400
@@ -0,0 +1,28 @@
+import asyncio
+
+import httpx
+
+
+def fetch(main, path, token=None):
+    async def scenario():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            headers = {"Authorization": f"Bearer {token}"} if token else {}
+            return await client.get(path, headers=headers)
+
+    return asyncio.run(scenario())
+
+
+def test_operational_endpoints_are_disabled_without_a_token(main, monkeypatch):
+    monkeypatch.setattr(main, "METRICS_TOKEN", None)
+    for path in ("/api/stats", "/api/metrics"):
+        assert fetch(main, path, token="anything").status_code == 404
+
+
+def test_operational_endpoints_require_the_token(main, monkeypatch):
+    monkeypatch.setattr(main, "METRICS_TOKEN", "s3cret")
+    for path in ("/api/stats", "/api/metrics"):
+        assert fetch(main, path).status_code == 401
+        assert fetch(main, path, token="wrong").status_code == 401
+        assert fetch(main, path, token="s3cret").status_code == 200
+    assert "nutrisnap_events_total" in fetch(main, "/api/metrics", token="s3cret").text
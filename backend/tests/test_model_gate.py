@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+
+def test_in_flight_calls_stay_bounded(main):
+    gate = main.ModelGate(max_in_flight=2, max_queue=10, max_guest_queue=10)
+    peak = 0
+
+    async def call():
+        nonlocal peak
+        async with gate.slot():
+            peak = max(peak, gate.in_flight)
+            await asyncio.sleep(0.005)
+
+    async def scenario():
+        await asyncio.gather(*(call() for _ in range(8)))
+
+    asyncio.run(scenario())
+    assert peak == 2
+    assert gate.in_flight == 0 and gate.waiting == 0
+
+
+def test_full_queue_sheds_with_503(main):
+    gate = main.ModelGate(max_in_flight=1, max_queue=1, max_guest_queue=1)
+
+    async def hold(release: asyncio.Event):
+        async with gate.slot():
+            await release.wait()
+
+    async def scenario():
+        release = asyncio.Event()
+        running = asyncio.create_task(hold(release))
+        queued = asyncio.create_task(hold(release))
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as error:
+            async with gate.slot():
+                pass
+        release.set()
+        await asyncio.gather(running, queued)
+        return error.value
+
+    error = asyncio.run(scenario())
+    assert error.status_code == 503
+    assert error.headers["Retry-After"] == "2"
+    assert gate.in_flight == 0
+
+
+def test_timed_out_waiter_leaves_the_queue(main):
+    gate = main.ModelGate(max_in_flight=1, max_queue=4, max_guest_queue=4)
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def hold():
+            async with gate.slot():
+                await release.wait()
+
+        running = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        with pytest.raises(asyncio.TimeoutError):
+            async with gate.slot(timeout=0.01):
+                pass
+        assert gate.waiting == 0
+        release.set()
+        await running
+        # The slot was not leaked: a new caller gets straight in.
+        async with gate.slot(timeout=0.01):
+            assert gate.in_flight == 1
+
+    asyncio.run(scenario())
+    assert gate.in_flight == 0
@@ -0,0 +1,61 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+from benchmarks.fakes import default_payload
+
+
+def test_cut_inside_string_is_closed(main):
+    assert main.repair_truncated_json('{"a": "unterminated') == {"a": "unterminated"}
+    assert main.repair_truncated_json('{"a": ["x", "y\\') == {"a": ["x", "y"]}
+
+
+def test_cut_before_first_complete_recipe_is_502(main):
+    with pytest.raises(HTTPException) as error:
+        main.parse_model_text('{"recipes": [{"name": "a"', main.RecipeSuggestions)
+    assert error.value.status_code == 502
+
+
+def test_empty_detection_salvage_is_502(main):
+    with pytest.raises(HTTPException) as error:
+        main.parse_model_text('{"detected_ingredients": [', main.IngredientDetection)
+    assert error.value.status_code == 502
+
+
+def test_complete_output_is_not_marked_salvaged(main):
+    text = json.dumps({key: default_payload(1)[key] for key in ("recipes", "ranking")})
+    assert not main.parse_model_text(text, main.RecipeSuggestions).salvaged
+
+
+def test_truncated_output_keeps_complete_recipes(main):
+    text = json.dumps({key: default_payload(2)[key] for key in ("recipes", "ranking")})
+    cut = text[: text.index('"Bench Recipe 2"') + 10]
+    result = main.parse_model_text(cut, main.RecipeSuggestions)
+    assert [recipe.name for recipe in result.recipes] == ["Bench Recipe 1"]
+    assert result.salvaged
+
+
+def test_partial_analysis_is_served_but_not_cached(main, models, monkeypatch):
+    payload = default_payload(2)
+    recipes_text = json.dumps({key: payload[key] for key in ("recipes", "ranking")})
+    truncated = recipes_text[: recipes_text.index('"Bench Recipe 2"') + 10]
+
+    async def generate_content(model, contents, config=None):
+        if models._is_detection(config):
+            text = json.dumps({"detected_ingredients": payload["detected_ingredients"]})
+        else:
+            text = truncated
+        return SimpleNamespace(text=text, parsed=None, usage_metadata=None)
+
+    monkeypatch.setattr(models, "generate_content", generate_content)
+    image = b"partial-analysis-image"
+    prefs = main.DEFAULT_PREFERENCES
+    result = asyncio.run(main.analyze_image(image, "image/jpeg", prefs))
+    assert result["partial"] is True
+    assert len(result["recipes"]) == 1
+
+    analysis_id = asyncio.run(main.image_analysis_id(image))
+    assert main.analysis_cache.get(main.analysis_cache_key(analysis_id, prefs)) is None
@@ -0,0 +1,53 @@
+import asyncio
+from types import SimpleNamespace
+
+
+def make_store(main, tmp_path):
+    return main.LocalUserStore(tmp_path / "store.sqlite3")
+
+
+def test_outbox_keeps_only_the_newest_rows(main, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "OUTBOX_MAX_ROWS", 3)
+    store = make_store(main, tmp_path)
+    for n in range(5):
+        store.set_preferences("outbox-user", {"calorie_target": str(n)})
+    rows = store.pending_writes(10)
+    assert [row[5]["calorie_target"] for row in rows] == ["2", "3", "4"]
+    assert store.outbox_depth() == {"pending": 3, "dead": 2}
+
+
+def test_old_rows_are_dead_lettered(main, tmp_path, monkeypatch):
+    store = make_store(main, tmp_path)
+    store.set_preferences("outbox-user", {})
+    monkeypatch.setattr(main, "OUTBOX_MAX_AGE_SECONDS", -1)
+    store.prune_pending()
+    assert store.outbox_depth() == {"pending": 0, "dead": 1}
+
+
+class RejectingRepository:
+    def __init__(self, error):
+        self.error = error
+        self.breaker = SimpleNamespace(state="closed")
+
+    async def replay_local_writes(self, rows):
+        raise self.error
+
+
+def test_rows_rejected_repeatedly_are_dead_lettered(main, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "OUTBOX_MAX_ATTEMPTS", 2)
+    store = make_store(main, tmp_path)
+    store.set_preferences("outbox-user", {})
+    reconciler = main.LocalWriteReconciler(RejectingRepository(ValueError("invalid document")), store)
+    asyncio.run(reconciler.run_once())
+    assert store.outbox_depth() == {"pending": 1, "dead": 0}
+    asyncio.run(reconciler.run_once())
+    assert store.outbox_depth() == {"pending": 0, "dead": 1}
+
+
+def test_outage_failures_do_not_count_as_attempts(main, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "OUTBOX_MAX_ATTEMPTS", 1)
+    store = make_store(main, tmp_path)
+    store.set_preferences("outbox-user", {})
+    reconciler = main.LocalWriteReconciler(RejectingRepository(main.GoogleServiceUnavailable("down")), store)
+    asyncio.run(reconciler.run_once())
+    assert store.outbox_depth() == {"pending": 1, "dead": 0}
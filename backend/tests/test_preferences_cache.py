@@ -0,0 +1,40 @@
+import asyncio
+
+
+def test_read_in_flight_during_write_does_not_restore_old_preferences(main, monkeypatch):
+    uid = "pref-race"
+    main.preferences_cache.pop(uid)
+    read_started = asyncio.Event()
+    finish_read = asyncio.Event()
+
+    async def slow_get_user(_uid):
+        read_started.set()
+        await finish_read.wait()
+        return {"preferences": {"diet_type": "non-vegetarian"}}
+
+    async def scenario():
+        reader = asyncio.create_task(main.get_user_preferences(uid))
+        await read_started.wait()
+        await main.update_preferences({"diet_type": "vegan"}, uid=uid)
+        finish_read.set()
+        stale = await reader
+        return stale, await main.get_user_preferences(uid)
+
+    monkeypatch.setattr(main.user_repository, "get_user", slow_get_user)
+    stale, current = asyncio.run(scenario())
+    assert stale["diet_type"] == "non-vegetarian"
+    assert current["diet_type"] == "vegan"
+    assert current["allergies"] == main.DEFAULT_PREFERENCES["allergies"]
+
+
+def test_profile_write_with_preferences_refreshes_cache(main):
+    uid = "pref-profile"
+
+    async def scenario():
+        await main.update_preferences({"diet_type": "vegan"}, uid=uid)
+        await main.update_profile({"preferences": {"allergies": "peanuts"}}, uid=uid)
+        return await main.get_user_preferences(uid)
+
+    prefs = asyncio.run(scenario())
+    assert prefs["allergies"] == "peanuts"
+    assert prefs["diet_type"] == "vegan"
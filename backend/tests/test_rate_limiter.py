@@ -0,0 +1,130 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+
+def guest_request(ip: str = "203.0.113.7") -> Request:
+    return Request({"type": "http", "method": "POST", "path": "/", "headers": [], "client": (ip, 1234)})
+
+
+def make_limiter(main, capacity=2, per_second=10.0):
+    budgets = {(kind, signed_in): (capacity, per_second) for kind in ("model", "crud") for signed_in in (True, False)}
+    return main.RateLimiter(budgets, max_buckets=100)
+
+
+def test_bucket_empties_then_refills(main):
+    limiter = make_limiter(main)
+
+    async def scenario():
+        assert await limiter.take("model", "user:a", True) == 0
+        assert await limiter.take("model", "user:a", True) == 0
+        wait = await limiter.take("model", "user:a", True)
+        assert 0 < wait <= 0.1
+        await asyncio.sleep(0.12)
+        return await limiter.take("model", "user:a", True)
+
+    assert asyncio.run(scenario()) == 0
+
+
+def test_callers_and_budgets_are_separate(main):
+    limiter = make_limiter(main, capacity=1)
+
+    async def scenario():
+        assert await limiter.take("model", "user:a", True) == 0
+        assert await limiter.take("model", "user:a", True) > 0
+        assert await limiter.take("model", "user:b", True) == 0
+        assert await limiter.take("crud", "user:a", True) == 0
+
+    asyncio.run(scenario())
+
+
+def test_cost_is_charged_in_full(main):
+    limiter = make_limiter(main, capacity=4, per_second=0.01)
+
+    async def scenario():
+        assert await limiter.take("model", "user:a", True, cost=3) == 0
+        assert await limiter.take("model", "user:a", True, cost=2) > 0
+        assert await limiter.take("model", "user:a", True, cost=1) == 0
+        with pytest.raises(ValueError):
+            await limiter.take("model", "user:a", True, cost=5)
+
+    asyncio.run(scenario())
+
+
+def test_enforce_returns_429_with_retry_after(main, monkeypatch):
+    monkeypatch.setattr(main, "RATE_LIMIT_ENABLED", True)
+    monkeypatch.setattr(main, "rate_limiter", make_limiter(main, capacity=1, per_second=0.5))
+    request = guest_request()
+
+    async def scenario():
+        await main.enforce_rate_limit(request, "model", None)
+        with pytest.raises(HTTPException) as error:
+            await main.enforce_rate_limit(request, "model", None)
+        return error.value
+
+    error = asyncio.run(scenario())
+    assert error.status_code == 429
+    assert error.headers["Retry-After"] == "2"
+
+
+def test_batch_larger_than_bucket_is_refused(main, monkeypatch):
+    monkeypatch.setattr(main, "RATE_LIMIT_ENABLED", True)
+    monkeypatch.setattr(main, "rate_limiter", make_limiter(main, capacity=3, per_second=0.01))
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(main.enforce_rate_limit(guest_request(), "model", None, cost=8))
+    assert error.value.status_code == 413
+
+
+def test_redis_failure_falls_back_to_local_buckets(main, monkeypatch):
+    class BrokenScript:
+        def __init__(self, client):
+            self.registered_client = client
+
+        async def __call__(self, keys, args):
+            raise ConnectionError("redis down")
+
+    class BrokenRedis:
+        def register_script(self, source):
+            return BrokenScript(self)
+
+    client = BrokenRedis()
+    monkeypatch.setattr(main, "get_redis_client", lambda: client)
+    limiter = make_limiter(main, capacity=1, per_second=0.01)
+
+    async def scenario():
+        assert await limiter.take("model", "user:a", True) == 0
+        assert await limiter.take("model", "user:a", True) > 0
+
+    asyncio.run(scenario())
+
+
+def test_gate_serves_signed_in_callers_before_guests(main):
+    order = []
+
+    async def call(gate, name, signed_in):
+        main.caller_signed_in.set(signed_in)
+        try:
+            async with gate.slot():
+                order.append(name)
+                await asyncio.sleep(0.01)
+            return "ok"
+        except HTTPException as error:
+            return error.status_code
+
+    async def scenario():
+        gate = main.ModelGate(max_in_flight=1, max_queue=3, max_guest_queue=2)
+        tasks = []
+        for name, signed_in in [("u0", True), ("g1", False), ("g2", False), ("g3", False), ("u1", True), ("u2", True)]:
+            tasks.append(asyncio.create_task(call(gate, name, signed_in)))
+            await asyncio.sleep(0)
+        results = await asyncio.gather(*tasks)
+        return results, gate
+
+    results, gate = asyncio.run(scenario())
+    # g3 is shed (guest queue full); u2 takes the newest waiting guest's (g2) place.
+    assert results == ["ok", "ok", 503, 503, "ok", "ok"]
+    assert order == ["u0", "u1", "u2", "g1"]
+    assert gate.in_flight == 0 and gate.waiting == 0
@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+
+def test_saving_the_same_recipe_twice_keeps_one_copy(main):
+    repository = main.user_repository
+    recipe = {"name": "Shakshuka", "ingredients": ["egg", "tomato"]}
+
+    async def scenario():
+        first = await repository.add_saved_recipe("repo-saved", recipe)
+        second = await repository.add_saved_recipe("repo-saved", {**recipe, "id": "ignored"})
+        items, _ = await repository.list_page("saved_recipes", "repo-saved", 10)
+        return first, second, items
+
+    first, second, items = asyncio.run(scenario())
+    assert first == second
+    assert [item["id"] for item in items] == [first]
+
+
+def test_list_page_walks_entries_newest_first(main):
+    repository = main.user_repository
+    uid = "repo-history"
+
+    async def scenario():
+        for n in range(5):
+            await repository.append_entries([("food_history", uid, {"analysis_id": str(n)})])
+            await asyncio.sleep(0.002)
+        seen, cursor = [], None
+        while True:
+            items, cursor = await repository.list_page("food_history", uid, 2, cursor)
+            seen += [item["analysis_id"] for item in items]
+            if cursor is None:
+                return seen
+
+    assert asyncio.run(scenario()) == ["4", "3", "2", "1", "0"]
+
+
+def test_other_errors_propagate_without_fallback(main):
+    breaker = main.CircuitBreaker("test", failure_threshold=1, reset_timeout=60)
+    repository = main.UserRepository(lambda: None, breaker)
+
+    async def remote():
+        raise ValueError("bad document")
+
+    with pytest.raises(ValueError):
+        asyncio.run(repository._call(remote, lambda: "local"))
+    assert breaker.state == "closed"
+
+
+def test_firestore_cursor_resumes_in_the_local_store(main, tmp_path):
+    uid = "repo-flip"
+
+    async def firestore_first_page():
+        for n in range(4):
+            await main.user_repository.append_entries([("food_history", uid, {"analysis_id": f"remote-{n}"})])
+            await asyncio.sleep(0.002)
+        return await main.user_repository.list_page("food_history", uid, 2)
+
+    items, cursor = asyncio.run(firestore_first_page())
+    assert [item["analysis_id"] for item in items] == ["remote-3", "remote-2"]
+    cursor_ts, _ = main.decode_page_cursor(cursor)
+
+    store = main.LocalUserStore(tmp_path / "store.sqlite3")
+    store.add_entries("food_history", uid, [
+        {"analysis_id": "local-old", "analyzed_at": "2000-01-01T00:00:00+00:00"},
+        {"analysis_id": "local-new", "analyzed_at": "2999-01-01T00:00:00+00:00"},
+    ])
+    local_items, _ = store.list_page("food_history", uid, 10, cursor)
+    assert [item["analysis_id"] for item in local_items] == ["local-old"]
+    assert cursor_ts > "2000"
+
+
+def test_local_cursor_resumes_in_firestore(main, tmp_path):
+    uid = "repo-flip-back"
+    store = main.LocalUserStore(tmp_path / "store.sqlite3")
+    store.add_entries("food_history", uid, [
+        {"analysis_id": f"local-{n}", "analyzed_at": f"2000-01-0{n + 1}T00:00:00+00:00"} for n in range(3)
+    ])
+    _, cursor = store.list_page("food_history", uid, 1)
+
+    async def firestore_page():
+        await main.user_repository.append_entries([("food_history", uid, {"analysis_id": "remote-now"})])
+        return await main.user_repository.list_page("food_history", uid, 10, cursor)
+
+    items, next_cursor = asyncio.run(firestore_page())
+    # Everything in Firestore is newer than the local cursor, so nothing older is left to show.
+    assert items == [] and next_cursor is None
+
+
+def test_malformed_cursor_is_rejected(main):
+    with pytest.raises(main.HTTPException) as error:
+        asyncio.run(main.user_repository.list_page("food_history", "repo-bad", 2, "not a cursor"))
+    assert error.value.status_code == 400
@@ -0,0 +1,151 @@
+import asyncio
+
+import httpx
+import pytest
+
+from benchmarks.run import make_images
+
+
+def test_concurrent_calls_share_one_run(main):
+    flights = main.SingleFlight("test")
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"value": 1}
+
+    async def scenario():
+        return await asyncio.gather(*(flights.run("key", work) for _ in range(3)))
+
+    results = asyncio.run(scenario())
+    assert results == [{"value": 1}] * 3
+    assert len(calls) == 1
+    assert len(flights) == 0
+
+
+def test_leader_failure_reaches_every_caller_and_is_not_kept(main):
+    flights = main.SingleFlight("test")
+    calls = []
+
+    async def failing():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise RuntimeError("model down")
+
+    async def scenario():
+        results = await asyncio.gather(*(flights.run("key", failing) for _ in range(3)), return_exceptions=True)
+        assert len(flights) == 0
+        retried = await flights.run("key", lambda: asyncio.sleep(0, result="ok"))
+        return results, retried
+
+    results, retried = asyncio.run(scenario())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert len(calls) == 1
+    assert retried == "ok"
+
+
+def test_cancelled_follower_leaves_the_work_running(main):
+    flights = main.SingleFlight("test")
+
+    async def scenario():
+        leader = asyncio.create_task(flights.run("key", lambda: asyncio.sleep(0.02, result="done")))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flights.run("key", lambda: asyncio.sleep(0, result="unused")))
+        await asyncio.sleep(0.005)
+        follower.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await follower
+        return await leader
+
+    assert asyncio.run(scenario()) == "done"
+
+
+def test_cancelled_leader_hands_the_work_to_followers(main):
+    flights = main.SingleFlight("test")
+
+    async def scenario():
+        leader = asyncio.create_task(flights.run("key", lambda: asyncio.sleep(0.02, result="done")))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flights.run("key", lambda: asyncio.sleep(0, result="unused")))
+        await asyncio.sleep(0.005)
+        leader.cancel()
+        return await follower
+
+    assert asyncio.run(scenario()) == "done"
+
+
+def test_work_is_cancelled_when_every_caller_leaves(main):
+    flights = main.SingleFlight("test")
+
+    async def scenario():
+        state = {"cancelled": False}
+
+        async def work():
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                state["cancelled"] = True
+                raise
+
+        callers = [asyncio.create_task(flights.run("key", work)) for _ in range(2)]
+        await asyncio.sleep(0.005)
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.sleep(0)
+        return state["cancelled"], len(flights)
+
+    assert asyncio.run(scenario()) == (True, 0)
+
+
+def test_concurrent_streams_share_one_generation(main, models):
+    # Unique pixels so neither the caches nor earlier tests answer this upload.
+    image = make_images(2, size=(641, 481))[1]
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            def stream():
+                return client.post("/api/analyze-food/stream", files={"image": ("a.jpg", image, "image/jpeg")})
+
+            def plain():
+                return client.post("/api/analyze-food", files={"image": ("a.jpg", image, "image/jpeg")})
+
+            return await asyncio.gather(stream(), stream(), plain())
+
+    before = models.calls
+    first, second, plain = asyncio.run(scenario())
+    assert models.calls - before == 2  # one detection, one streamed generation
+    for response in (first, second):
+        assert "event: ingredients" in response.text
+        assert "event: recipe" in response.text
+        assert "event: done" in response.text
+    assert plain.status_code == 200
+    assert len(plain.json()["recipes"]) == 2
+
+
+def test_signed_in_callers_do_not_join_guest_work(main):
+    flights = main.SingleFlight("test")
+    calls = []
+
+    async def work():
+        calls.append(main.caller_signed_in.get())
+        await asyncio.sleep(0.01)
+        return "done"
+
+    async def call(signed_in):
+        main.caller_signed_in.set(signed_in)
+        return await flights.run("key", work)
+
+    async def scenario():
+        guest = asyncio.create_task(call(False))
+        await asyncio.sleep(0)
+        user = asyncio.create_task(call(True))
+        await asyncio.sleep(0)
+        late_guest = asyncio.create_task(call(False))
+        return await asyncio.gather(guest, user, late_guest)
+
+    assert asyncio.run(scenario()) == ["done"] * 3
+    # The user led their own work at signed-in priority; the late guest joined one of the two.
+    assert calls == [False, True]
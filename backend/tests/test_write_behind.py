@@ -0,0 +1,85 @@
+import asyncio
+
+
+class RecordingRepository:
+    def __init__(self, error: Exception | None = None):
+        self.error = error
+        self.batches: list[list] = []
+        self.direct: list[list] = []
+        self.spilled: list = []
+
+    async def append_entries(self, writes, fallback=True):
+        if fallback:
+            self.direct.append(list(writes))
+            return
+        if self.error is not None:
+            raise self.error
+        self.batches.append(list(writes))
+
+    def append_entries_locally(self, writes):
+        self.spilled.extend(writes)
+
+
+def entry(n):
+    return ("food_history", "uid", {"analysis_id": str(n)})
+
+
+def test_entries_are_coalesced_into_one_batch(main):
+    repository = RecordingRepository()
+    queue = main.WriteBehindQueue(repository, batch_size=100, interval=0.02, max_size=100)
+
+    async def scenario():
+        queue.start()
+        for n in range(5):
+            await queue.submit([entry(n)])
+        await asyncio.sleep(0.05)
+        await queue.drain(1.0)
+
+    asyncio.run(scenario())
+    assert repository.batches == [[entry(n) for n in range(5)]]
+    assert repository.direct == [] and repository.spilled == []
+
+
+def test_drain_on_shutdown_loses_nothing(main):
+    repository = RecordingRepository()
+    # A long interval keeps the entries waiting in the worker when shutdown begins.
+    queue = main.WriteBehindQueue(repository, batch_size=100, interval=10.0, max_size=100)
+
+    async def scenario():
+        queue.start()
+        await queue.submit([entry(n) for n in range(3)])
+        await asyncio.sleep(0.01)
+        await queue.drain(0.05)
+        await queue.submit([entry(3)])
+
+    asyncio.run(scenario())
+    assert repository.batches == []
+    assert repository.spilled == [entry(n) for n in range(3)]
+    assert repository.direct == [[entry(3)]]  # stopped queues write straight through
+
+
+def test_failed_flush_spills_to_the_local_store(main):
+    repository = RecordingRepository(error=ValueError("rejected"))
+    queue = main.WriteBehindQueue(repository, batch_size=2, interval=0.01, max_size=100)
+
+    async def scenario():
+        queue.start()
+        await queue.submit([entry(n) for n in range(4)])
+        await queue.drain(1.0)
+
+    asyncio.run(scenario())
+    assert repository.spilled == [entry(n) for n in range(4)]
+
+
+def test_full_queue_writes_the_overflow_directly(main):
+    repository = RecordingRepository()
+    queue = main.WriteBehindQueue(repository, batch_size=100, interval=10.0, max_size=2)
+
+    async def scenario():
+        queue.start()
+        await queue.submit([entry(n) for n in range(5)])
+        await queue.drain(0.01)
+
+    asyncio.run(scenario())
+    assert repository.direct[0][-2:] == [entry(3), entry(4)]
+    assert sorted(e[2]["analysis_id"] for e in repository.direct[0] + repository.spilled) == [str(n) for n in range(5)]
@@ -1,51 +1,141 @@
+import time
+
+# Taken before any other import so the cold-start report covers all module-level work.
+_IMPORT_STARTED = time.perf_counter()
+
+import asyncio
+import base64
+import copy
+import functools
+import hashlib
+import hmac
+import importlib
+import io
 import json
+import logging
+import math
 import os
+import random
 import re
+import sqlite3
+import threading
 import httpx
+from bisect import bisect_left
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
 from pathlib import Path
+from typing import Annotated, Literal
 from datetime import datetime, timezone
 from uuid import uuid4
 
 from dotenv import load_dotenv
-from fastapi import Depends, FastAPI, File, HTTPException, UploadFile
+from fastapi import Depends, FastAPI, File, HTTPException, Query, Request, Response, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 
-from google import genai
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # Preference caching stays in-process without the redis package
+    aioredis = None
+
+from google.api_core.exceptions import Aborted as GoogleAborted
+from google.api_core.exceptions import AlreadyExists as GoogleAlreadyExists
+from google.api_core.exceptions import DeadlineExceeded as GoogleDeadlineExceeded
+from google.api_core.exceptions import InternalServerError as GoogleInternalServerError
 from google.api_core.exceptions import PermissionDenied as GooglePermissionDenied
+from google.api_core.exceptions import ResourceExhausted as GoogleResourceExhausted
 from google.api_core.exceptions import ServiceUnavailable as GoogleServiceUnavailable
-from google.genai import types
+from pydantic import BaseModel, BeforeValidator, PrivateAttr, ValidationError
 
-import firebase_admin
-from firebase_admin import auth, credentials, firestore
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Without Pillow, uploads are forwarded as-is and cache keys use content hashes
+    Image = ImageOps = None
 
 BASE_DIR = Path(__file__).resolve().parent
 FRONTEND_DIR = BASE_DIR.parent
 load_dotenv(FRONTEND_DIR / ".env")
 
-service_account_json = os.getenv("GCP_SERVICE_ACCOUNT_JSON")
-credentials_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
-
-if service_account_json:
-    temp_path = Path("/tmp/gcp-service-account.json")
-    temp_path.write_text(service_account_json, encoding="utf-8")
-    credentials_path = str(temp_path)
-elif credentials_path:
-    credentials_candidate = Path(credentials_path)
-    if not credentials_candidate.is_absolute():
-        credentials_candidate = FRONTEND_DIR / credentials_candidate
-    if credentials_candidate.exists():
-        credentials_path = str(credentials_candidate.resolve())
-    else:
-        credentials_path = None
-
-if credentials_path:
-    credentials_file = Path(credentials_path)
-    if not credentials_file.is_absolute():
-        credentials_file = FRONTEND_DIR / credentials_file
-    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = str(credentials_file.resolve())
-
-app = FastAPI()
+# What this instance spent on startup; served by /api/cold-start.
+cold_start_report: dict = {"module_import_ms": None, "deferred_imports_ms": {}, "clients_ms": {}, "first_request": None}
+
+
+class DeferredModule:
+    """Stands in for a module and imports it on first attribute access, so SDKs that a route
+    does not use never load on that cold start. Import time goes into the cold-start report."""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr: str):
+        module = self._module
+        if module is None:
+            started = time.perf_counter()
+            module = importlib.import_module(self._name)
+            if self._module is None:
+                cold_start_report["deferred_imports_ms"][self._name] = round((time.perf_counter() - started) * 1000, 1)
+                self._module = module
+        return getattr(module, attr)
+
+
+genai = DeferredModule("google.genai")
+types = DeferredModule("google.genai.types")
+google_jwt = DeferredModule("google.auth.jwt")
+firebase_admin = DeferredModule("firebase_admin")
+auth = DeferredModule("firebase_admin.auth")
+firestore = DeferredModule("firebase_admin.firestore")
+
+
+class LazyClient:
+    """Thread-safe singleton built by ``factory`` on first ``get()``. A failed build is kept
+    and re-raised, so a misconfigured deployment fails every request the same way instead of
+    retrying the setup each time."""
+
+    def __init__(self, name: str, factory):
+        self.name = name
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._value = None
+        self.error: Exception | None = None
+
+    def get(self):
+        if self._value is None:
+            with self._lock:
+                if self._value is None and self.error is None:
+                    started = time.perf_counter()
+                    try:
+                        self._value = self._factory()
+                    except Exception as exc:
+                        self.error = exc
+                    cold_start_report["clients_ms"][self.name] = round((time.perf_counter() - started) * 1000, 1)
+        if self.error is not None:
+            raise self.error
+        return self._value
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    rollup_task = None
+    if WRITE_BEHIND_ENABLED:
+        write_behind.start()
+        rollup_task = asyncio.create_task(feedback_rollup.run_loop())
+    yield
+    if rollup_task is not None:
+        rollup_task.cancel()
+    await write_behind.drain(timeout=5)
+    await feedback_rollup.run_once()
+    if _http_client is not None:
+        await _http_client.aclose()
+    if _redis_client is not None:
+        await _redis_client.aclose()
+    _image_executor.shutdown(wait=False)
+
+
+app = FastAPI(lifespan=lifespan)
 
 frontend_origins = os.getenv("FRONTEND_ORIGINS")
 if frontend_origins:
@@ -59,38 +149,148 @@ app.add_middleware(
     allow_credentials=False,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Request-ID", "Server-Timing"],
 )
 
+
+
+@app.middleware("http")
+async def record_first_request(request: Request, call_next):
+    """Adds the first request on this instance to the cold-start report: how long after the
+    import started it finished, and what it spent itself."""
+    if cold_start_report["first_request"] is not None:
+        return await call_next(request)
+    cold_start_report["first_request"] = {"path": request.url.path}
+    started = time.perf_counter()
+    response = await call_next(request)
+    finished = time.perf_counter()
+    cold_start_report["first_request"].update(
+        duration_ms=round((finished - started) * 1000, 1),
+        ready_ms=round((finished - _IMPORT_STARTED) * 1000, 1),
+    )
+    return response
+
+
 security = HTTPBearer(auto_error=False)
 db = None
-client = None
 project_id = os.getenv("GCP_PROJECT_ID")
 location = os.getenv("GCP_LOCATION", "us-central1")
 model_name = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
-INIT_ERROR = None
+MODEL_MAX_IN_FLIGHT = int(os.getenv("MODEL_MAX_IN_FLIGHT", "4"))
+MODEL_MAX_QUEUE = int(os.getenv("MODEL_MAX_QUEUE", "8"))
+MODEL_GUEST_MAX_QUEUE = int(os.getenv("MODEL_GUEST_MAX_QUEUE", str(MODEL_MAX_QUEUE // 4)))
+MODEL_TIMEOUT_SECONDS = float(os.getenv("MODEL_TIMEOUT_SECONDS", "55"))
+YOUTUBE_ENRICH_BUDGET_SECONDS = float(os.getenv("YOUTUBE_ENRICH_BUDGET_SECONDS", "1.5"))
+YOUTUBE_CACHE_SIZE = int(os.getenv("YOUTUBE_CACHE_SIZE", "2048"))
+YOUTUBE_CACHE_TTL_SECONDS = float(os.getenv("YOUTUBE_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+YOUTUBE_CACHE_NEGATIVE_TTL_SECONDS = float(os.getenv("YOUTUBE_CACHE_NEGATIVE_TTL_SECONDS", "3600"))
+YOUTUBE_CACHE_DISK = os.getenv("YOUTUBE_CACHE_DISK", "1") == "1"
+ANALYSIS_CACHE_SIZE = int(os.getenv("ANALYSIS_CACHE_SIZE", "256"))
+ANALYSIS_CACHE_TTL_SECONDS = float(os.getenv("ANALYSIS_CACHE_TTL_SECONDS", "3600"))
+ANALYSIS_CACHE_PERCEPTUAL = os.getenv("ANALYSIS_CACHE_PERCEPTUAL", "0") == "1"
+DETECTION_MODEL = os.getenv("DETECTION_MODEL", model_name)
+DETECTION_CACHE_SIZE = int(os.getenv("DETECTION_CACHE_SIZE", "1024"))
+DETECTION_CACHE_TTL_SECONDS = float(os.getenv("DETECTION_CACHE_TTL_SECONDS", str(24 * 3600)))
+BATCH_MAX_IMAGES = int(os.getenv("BATCH_MAX_IMAGES", "4"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "3"))
+PREFERENCES_CACHE_SIZE = int(os.getenv("PREFERENCES_CACHE_SIZE", "4096"))
+PREFERENCES_CACHE_TTL_SECONDS = float(os.getenv("PREFERENCES_CACHE_TTL_SECONDS", "300"))
+REDIS_URL = os.getenv("REDIS_URL")
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+RATE_LIMIT_MODEL_PER_MINUTE = float(os.getenv("RATE_LIMIT_MODEL_PER_MINUTE", "20"))
+RATE_LIMIT_MODEL_BURST = float(os.getenv("RATE_LIMIT_MODEL_BURST", "10"))
+RATE_LIMIT_GUEST_MODEL_PER_MINUTE = float(os.getenv("RATE_LIMIT_GUEST_MODEL_PER_MINUTE", "5"))
+RATE_LIMIT_GUEST_MODEL_BURST = float(os.getenv("RATE_LIMIT_GUEST_MODEL_BURST", "3"))
+RATE_LIMIT_CRUD_PER_MINUTE = float(os.getenv("RATE_LIMIT_CRUD_PER_MINUTE", "300"))
+RATE_LIMIT_CRUD_BURST = float(os.getenv("RATE_LIMIT_CRUD_BURST", "60"))
+RATE_LIMIT_GUEST_CRUD_PER_MINUTE = float(os.getenv("RATE_LIMIT_GUEST_CRUD_PER_MINUTE", "60"))
+RATE_LIMIT_GUEST_CRUD_BURST = float(os.getenv("RATE_LIMIT_GUEST_CRUD_BURST", "20"))
+RATE_LIMIT_TRUST_FORWARDED = os.getenv("RATE_LIMIT_TRUST_FORWARDED", "1") == "1"
+RATE_LIMIT_MAX_BUCKETS = 65536
+AUTH_TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", "4096"))
+AUTH_CERT_REFRESH_MARGIN_SECONDS = 600
+FIREBASE_CERTS_URL = "https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com"
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "0") == "1"
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "200"))
+WRITE_BEHIND_INTERVAL_SECONDS = float(os.getenv("WRITE_BEHIND_INTERVAL_SECONDS", "0.5"))
+WRITE_BEHIND_MAX_QUEUE = int(os.getenv("WRITE_BEHIND_MAX_QUEUE", "10000"))
+WRITE_BEHIND_MAX_ATTEMPTS = 4
+FIRESTORE_BREAKER_FAILURES = int(os.getenv("FIRESTORE_BREAKER_FAILURES", "3"))
+FIRESTORE_BREAKER_RESET_SECONDS = float(os.getenv("FIRESTORE_BREAKER_RESET_SECONDS", "30"))
+FIRESTORE_PROBE_TIMEOUT_SECONDS = float(os.getenv("FIRESTORE_PROBE_TIMEOUT_SECONDS", "5"))
+RECONCILE_INTERVAL_SECONDS = float(os.getenv("RECONCILE_INTERVAL_SECONDS", "60"))
+# Bounds on local writes waiting for Firestore; rows past them move to the outbox_dead table.
+OUTBOX_MAX_ROWS = int(os.getenv("OUTBOX_MAX_ROWS", "10000"))
+OUTBOX_MAX_AGE_SECONDS = float(os.getenv("OUTBOX_MAX_AGE_SECONDS", str(7 * 24 * 3600)))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+PAGE_DEFAULT_LIMIT = 50
+PAGE_MAX_LIMIT = 100
+BOOTSTRAP_PAGE_LIMIT = 20
+SAVE_BATCH_MAX = 50
+FEEDBACK_COUNTER_SHARDS = int(os.getenv("FEEDBACK_COUNTER_SHARDS", "8"))
+FEEDBACK_ROLLUP_INTERVAL_SECONDS = float(os.getenv("FEEDBACK_ROLLUP_INTERVAL_SECONDS", "30"))
+POPULAR_RECIPES_CACHE_TTL_SECONDS = float(os.getenv("POPULAR_RECIPES_CACHE_TTL_SECONDS", "60"))
+POPULAR_RECIPES_MAX_LIMIT = 50
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "1536"))
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "jpeg").lower()
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+COLD_START_TARGET_MS = float(os.getenv("COLD_START_TARGET_MS", "1500"))
+
+
+def _resolve_credentials_path() -> str | None:
+    service_account_json = os.getenv("GCP_SERVICE_ACCOUNT_JSON")
+    credentials_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
+
+    if service_account_json:
+        temp_path = Path("/tmp/gcp-service-account.json")
+        temp_path.write_text(service_account_json, encoding="utf-8")
+        credentials_path = str(temp_path)
+    elif credentials_path:
+        credentials_candidate = Path(credentials_path)
+        if not credentials_candidate.is_absolute():
+            credentials_candidate = FRONTEND_DIR / credentials_candidate
+        if credentials_candidate.exists():
+            credentials_path = str(credentials_candidate.resolve())
+        else:
+            credentials_path = None
+
+    if credentials_path:
+        credentials_file = Path(credentials_path)
+        if not credentials_file.is_absolute():
+            credentials_file = FRONTEND_DIR / credentials_file
+        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = str(credentials_file.resolve())
+    return credentials_path
+
+
+def _init_firebase_app():
+    if firebase_admin._apps:
+        return firebase_admin.get_app()
+    cert_path = _resolve_credentials_path()
+    if not cert_path:
+        raise RuntimeError("Missing GOOGLE_APPLICATION_CREDENTIALS or GCP_SERVICE_ACCOUNT_JSON")
+    if not project_id:
+        raise RuntimeError("Missing GCP_PROJECT_ID")
 
-try:
-    if not firebase_admin._apps:
-        cert_path = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
-        if not cert_path:
-            raise RuntimeError("Missing GOOGLE_APPLICATION_CREDENTIALS or GCP_SERVICE_ACCOUNT_JSON")
-
-        cred = credentials.Certificate(cert_path)
-        firebase_admin.initialize_app(
-            cred,
-            {
-                "projectId": project_id,
-            },
-        )
+    from firebase_admin import credentials
+
+    cred = credentials.Certificate(os.environ["GOOGLE_APPLICATION_CREDENTIALS"])
+    return firebase_admin.initialize_app(
+        cred,
+        {
+            "projectId": project_id,
+        },
+    )
 
-    db = firestore.client()
 
+def _init_genai_client():
     if not project_id:
         raise RuntimeError("Missing GCP_PROJECT_ID")
+    return genai.Client(vertexai=True, project=project_id, location=location)
+
 
-    client = genai.Client(vertexai=True, project=project_id, location=location)
-except Exception as exc:
-    INIT_ERROR = str(exc)
+firebase_app = LazyClient("firebase_app", _init_firebase_app)
+genai_client = LazyClient("genai_client", _init_genai_client)
 
 
 FIRESTORE_PERMISSION_DETAIL = (
@@ -99,6 +299,7 @@ FIRESTORE_PERMISSION_DETAIL = (
     "to the service account and ensure Firestore is enabled in this project."
 )
 LOCAL_DATA_DIR = Path("/tmp/nutrisnap_local_data")
+YOUTUBE_SEARCH_URL = os.getenv("YOUTUBE_SEARCH_URL", "https://www.youtube.com/results")
 
 
 DEFAULT_PREFERENCES = {
@@ -112,379 +313,2726 @@ DEFAULT_PREFERENCES = {
 }
 
 
+runtime_stats: Counter = Counter()
+_MISSING = object()
+
+
+class TTLCache:
+    """In-process LRU cache whose entries expire after a TTL. Not shared across workers."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float | None = None) -> None:
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Bearer token for the operational endpoints (stats, metrics); unset keeps them disabled.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+REQUEST_ID_PATTERN = re.compile(r"[\w.:-]{1,64}")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+MODEL_TOKEN_FIELDS = {
+    "prompt": "prompt_token_count",
+    "cached": "cached_content_token_count",
+    "output": "candidates_token_count",
+    "thoughts": "thoughts_token_count",
+}
+CACHE_HIT_COUNTERS = {
+    "analysis": (("analysis_cache_hits",), ("analysis_cache_misses",)),
+    "detection": (("detection_cache_hits",), ("detection_cache_misses",)),
+    "preferences": (("preferences_cache_hits",), ("preferences_cache_misses",)),
+    "auth_token": (("auth_token_cache_hits",), ("auth_token_cache_misses",)),
+    "youtube": (
+        ("youtube_cache_memory_hits", "youtube_cache_disk_hits", "youtube_cache_negative_hits"),
+        ("youtube_cache_misses",),
+    ),
+}
+
+request_id_var: ContextVar[str | None] = ContextVar("request_id", default=None)
+request_timings_var: ContextVar[dict | None] = ContextVar("request_timings", default=None)
+
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line, tagged with the id of the request being served."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "message": record.getMessage(),
+            "request_id": request_id_var.get(),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+logger = logging.getLogger("nutrisnap")
+if not logger.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(JsonLogFormatter())
+    logger.addHandler(_log_handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    """Prometheus-style cumulative histogram with a fixed label set, rendered by /api/metrics."""
+
+    def __init__(self, name: str, help_text: str, labels: tuple, buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, *label_values) -> None:
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, label_values, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, label_values, le)} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, label_values)} {total:.6f}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, label_values)} {count}")
+        return lines
+
+
+request_duration = Histogram(
+    "nutrisnap_request_duration_seconds",
+    "Time to produce the response headers, by route template and status.",
+    ("method", "route", "status"),
+)
+stage_duration = Histogram(
+    "nutrisnap_stage_duration_seconds",
+    "Time spent in each request stage (auth, prefs, preprocess, detect, generate, youtube, ...).",
+    ("stage",),
+)
+model_tokens: Counter = Counter()
+
+
+def record_stage(name: str, seconds: float) -> None:
+    stage_duration.observe(seconds, name)
+    timings = request_timings_var.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+@contextmanager
+def stage(name: str):
+    """Times a block as one stage of the current request (for Server-Timing and the
+    stage histogram). Concurrent blocks with the same name add up."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - started)
+
+
+def timed(name: str):
+    """Decorator form of ``stage`` for coroutine functions."""
+
+    def decorate(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with stage(name):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def record_model_usage(model: str, usage) -> None:
+    """Adds a Gemini response's ``usage_metadata`` to the per-model token counters."""
+    if usage is None:
+        return
+    for kind, field in MODEL_TOKEN_FIELDS.items():
+        count = getattr(usage, field, None)
+        if count:
+            model_tokens[(model, kind)] += count
+
+
+def server_timing_header(timings: dict, total: float) -> str:
+    parts = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()]
+    parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
+
+
+@app.middleware("http")
+async def observe_requests(request: Request, call_next):
+    """Tags each request with an id (X-Request-ID, taken from the caller when valid), reports
+    its stages in a Server-Timing header, records it in the request histogram and logs one
+    structured line. For streamed responses this covers the time to the first byte."""
+    incoming = request.headers.get("x-request-id", "")
+    request_id = incoming if REQUEST_ID_PATTERN.fullmatch(incoming) else uuid4().hex[:16]
+    timings: dict[str, float] = {}
+    id_token = request_id_var.set(request_id)
+    timings_token = request_timings_var.set(timings)
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        elapsed = time.perf_counter() - started
+        route = getattr(request.scope.get("route"), "path", "unmatched")
+        request_duration.observe(elapsed, request.method, route, str(status))
+        logger.info("request", extra={"fields": {
+            "method": request.method,
+            "route": route,
+            "status": status,
+            "duration_ms": round(elapsed * 1000, 1),
+            "stages_ms": {name: round(seconds * 1000, 1) for name, seconds in timings.items()},
+        }})
+        request_id_var.reset(id_token)
+        request_timings_var.reset(timings_token)
+    response.headers["X-Request-ID"] = request_id
+    response.headers["Server-Timing"] = server_timing_header(timings, elapsed)
+    return response
+
+
 def _is_firestore_unavailable(exc: Exception) -> bool:
     return isinstance(exc, (GooglePermissionDenied, GoogleServiceUnavailable))
 
 
+def _is_transient_firestore_error(exc: Exception) -> bool:
+    return isinstance(exc, (GoogleServiceUnavailable, GoogleDeadlineExceeded, GoogleAborted, GoogleInternalServerError, GoogleResourceExhausted))
+
+
 def _ensure_local_store_dir() -> None:
     LOCAL_DATA_DIR.mkdir(parents=True, exist_ok=True)
 
 
-def _user_store_path(uid: str) -> Path:
-    safe_uid = "".join(ch for ch in uid if ch.isalnum() or ch in ("-", "_"))
-    return LOCAL_DATA_DIR / f"{safe_uid}.json"
+SAVED_RECIPE_SUMMARY_FIELDS = [
+    "name", "description", "health_score", "estimated_time_minutes", "diet_tags",
+    "ingredients_used", "additional_ingredients", "saved_at",
+]
+FOOD_HISTORY_SUMMARY_FIELDS = ["analysis_id", "detected_ingredients", "recipes_generated", "analyzed_at"]
+
+
+# Fields that vary between otherwise identical saves and must not change a recipe's id.
+_SAVED_RECIPE_VOLATILE_FIELDS = {"id", "saved_at", "youtube_video_id", "youtube_thumbnail"}
+
+
+def saved_recipe_id(recipe: dict) -> str:
+    """Content-addressed document id for a saved recipe, so saving the same recipe twice
+    lands on the same document."""
+    canonical = {key: value for key, value in recipe.items() if key not in _SAVED_RECIPE_VOLATILE_FIELDS}
+    payload = json.dumps(canonical, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
+def _project_entry(entry_id: str, data: dict, fields: list[str] | None) -> dict:
+    if fields is None:
+        return {"id": entry_id, **data}
+    return {"id": entry_id, **{field: data[field] for field in fields if field in data}}
+
+
+def encode_page_cursor(timestamp, entry_id: str) -> str:
+    """Cursor for the page after an entry: its timestamp and id, which Firestore and the local
+    store can both resume from, so "load more" keeps working when the breaker flips."""
+    if isinstance(timestamp, datetime):
+        timestamp = timestamp.isoformat()
+    raw = json.dumps([timestamp if isinstance(timestamp, str) else None, entry_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_page_cursor(cursor: str) -> tuple[str | None, str]:
+    try:
+        timestamp, entry_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if not isinstance(entry_id, str) or not (timestamp is None or isinstance(timestamp, str)):
+            raise ValueError(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid pagination cursor.")
+    return timestamp, entry_id
+
+
+# Weight of each feedback type in a recipe's popularity score; other types are counted only.
+FEEDBACK_SCORES = {"👍": 1, "👎": -1}
+# Every feedback type the app sends. Each becomes a counter field on the recipe's shared shard
+# documents, so arbitrary client strings must not reach them.
+FEEDBACK_TYPES = frozenset({*FEEDBACK_SCORES, "too_hard"})
+FEEDBACK_SUMMARY_FIELDS = ["name", "counts", "likes", "dislikes", "score"]
+
 
+def feedback_counter_key(recipe_name: str) -> str:
+    """Document id of a recipe's feedback counters; names are free text and not valid ids."""
+    return hashlib.sha256(recipe_name.strip().casefold().encode("utf-8")).hexdigest()[:32]
 
-def _default_user_store() -> dict:
+
+def _feedback_counts(entries) -> dict[str, tuple[str, Counter]]:
+    """Group feedback entries into per-recipe counts by feedback type, keyed by counter key."""
+    counts: dict[str, tuple[str, Counter]] = {}
+    for entry in entries:
+        name, feedback_type = entry.get("recipe_name"), entry.get("feedback_type")
+        if not (isinstance(name, str) and name.strip() and feedback_type in FEEDBACK_TYPES):
+            continue
+        counts.setdefault(feedback_counter_key(name), (name.strip(), Counter()))[1][feedback_type] += 1
+    return counts
+
+
+def _feedback_summary(name: str, counts: dict) -> dict:
     return {
-        "profile": {},
-        "preferences": DEFAULT_PREFERENCES.copy(),
-        "saved_recipes": [],
-        "food_history": [],
-        "feedback": [],
+        "name": name,
+        "counts": dict(counts),
+        "likes": sum(n for t, n in counts.items() if FEEDBACK_SCORES.get(t, 0) > 0),
+        "dislikes": sum(n for t, n in counts.items() if FEEDBACK_SCORES.get(t, 0) < 0),
+        "score": sum(n * FEEDBACK_SCORES.get(t, 0) for t, n in counts.items()),
     }
 
 
-def _read_user_store(uid: str) -> dict:
-    _ensure_local_store_dir()
-    path = _user_store_path(uid)
-    if not path.exists():
-        return _default_user_store()
-    try:
-        with path.open("r", encoding="utf-8") as f:
-            data = json.load(f)
-    except Exception:
-        return _default_user_store()
+class LocalUserStore:
+    """SQLite (WAL) store used when Firestore is unavailable.
+
+    Each collection has its own table indexed by ``(uid, timestamp)``. Every mutation is a
+    single transaction, so concurrent requests and multiple workers no longer overwrite each
+    other's changes the way whole-file JSON rewrites did. Entries are stored as the same dicts
+    the API returns. Legacy ``<uid>.json`` files in the data directory are imported on first use.
+    """
 
-    merged = _default_user_store()
-    merged.update(data if isinstance(data, dict) else {})
-    merged["preferences"] = {**DEFAULT_PREFERENCES, **(merged.get("preferences") or {})}
-    if not isinstance(merged.get("saved_recipes"), list):
-        merged["saved_recipes"] = []
-    if not isinstance(merged.get("food_history"), list):
-        merged["food_history"] = []
-    if not isinstance(merged.get("feedback"), list):
-        merged["feedback"] = []
-    if not isinstance(merged.get("profile"), dict):
-        merged["profile"] = {}
-    return merged
+    COLLECTIONS = {"saved_recipes": "saved_at", "food_history": "analyzed_at", "feedback": "created_at"}
+    LIMITS = {"food_history": 50, "feedback": 100}
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            _ensure_local_store_dir()
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS users ("
+                "uid TEXT PRIMARY KEY, profile TEXT NOT NULL DEFAULT '{}', preferences TEXT)"
+            )
+            for table in self.COLLECTIONS:
+                conn.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} ("
+                    "id TEXT PRIMARY KEY, uid TEXT NOT NULL, ts TEXT NOT NULL, analysis_id TEXT, data TEXT NOT NULL)"
+                )
+                conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_uid_ts ON {table} (uid, ts)")
+            conn.execute("CREATE INDEX IF NOT EXISTS food_history_uid_analysis ON food_history (uid, analysis_id)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, uid TEXT NOT NULL, op TEXT NOT NULL, "
+                "collection TEXT, doc_id TEXT, payload TEXT, attempts INTEGER NOT NULL DEFAULT 0, created_at REAL)"
+            )
+            outbox_columns = {row[1] for row in conn.execute("PRAGMA table_info(outbox)")}
+            if "attempts" not in outbox_columns:
+                conn.execute("ALTER TABLE outbox ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+                conn.execute("ALTER TABLE outbox ADD COLUMN created_at REAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS outbox_dead ("
+                "seq INTEGER PRIMARY KEY, uid TEXT NOT NULL, op TEXT NOT NULL, collection TEXT, doc_id TEXT, "
+                "payload TEXT, attempts INTEGER NOT NULL, created_at REAL, reason TEXT NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS feedback_totals ("
+                "recipe_key TEXT PRIMARY KEY, name TEXT NOT NULL, counts TEXT NOT NULL, score INTEGER NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS feedback_totals_score ON feedback_totals (score)")
+            self._conn = conn
+            self._migrate_json_files()
+        return self._conn
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def _query(self, sql: str, params: tuple) -> list:
+        with self._lock:
+            return self._connection().execute(sql, params).fetchall()
+
+    def get_user(self, uid: str) -> dict:
+        rows = self._query("SELECT profile, preferences FROM users WHERE uid = ?", (uid,))
+        profile, preferences = (json.loads(rows[0][0]), json.loads(rows[0][1] or "{}")) if rows else ({}, {})
+        return {"profile": profile, "preferences": {**DEFAULT_PREFERENCES, **preferences}}
+
+    def merge_profile(self, uid: str, profile: dict) -> None:
+        with self._transaction() as conn:
+            row = conn.execute("SELECT profile FROM users WHERE uid = ?", (uid,)).fetchone()
+            merged = {**(json.loads(row[0]) if row else {}), **profile}
+            conn.execute(
+                "INSERT INTO users (uid, profile) VALUES (?, ?) ON CONFLICT(uid) DO UPDATE SET profile = excluded.profile",
+                (uid, json.dumps(merged)),
+            )
+            self._record(conn, uid, "merge_profile", None, None, profile)
+
+    def set_preferences(self, uid: str, prefs: dict) -> dict:
+        stored = {**DEFAULT_PREFERENCES, **(prefs or {})}
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO users (uid, preferences) VALUES (?, ?) ON CONFLICT(uid) DO UPDATE SET preferences = excluded.preferences",
+                (uid, json.dumps(stored)),
+            )
+            self._record(conn, uid, "set_preferences", None, None, stored)
+        return stored
+
+    def list_page(self, collection: str, uid: str, limit: int, after: str | None = None, fields: list[str] | None = None) -> tuple[list[dict], str | None]:
+        """Newest-first page of entries after the entry with id ``after``, projected to ``fields``
+        (plus ``id``) when given. Returns the entries and the cursor of the next page, if any."""
+        anchor_ts, anchor_id = decode_page_cursor(after) if after else (None, None)
+        with self._lock:
+            conn = self._connection()
+            anchor = None
+            if anchor_id:
+                anchor = conn.execute(f"SELECT ts, rowid FROM {collection} WHERE uid = ? AND id = ?", (uid, anchor_id)).fetchone()
+            if anchor is not None:
+                rows = conn.execute(
+                    f"SELECT id, ts, data FROM {collection} WHERE uid = ? AND (ts < ? OR (ts = ? AND rowid < ?)) "
+                    "ORDER BY ts DESC, rowid DESC LIMIT ?",
+                    (uid, anchor[0], anchor[0], anchor[1], limit + 1),
+                ).fetchall()
+            elif anchor_ts:
+                # Cursor from Firestore for an entry this store does not have: resume by time.
+                rows = conn.execute(
+                    f"SELECT id, ts, data FROM {collection} WHERE uid = ? AND ts < ? ORDER BY ts DESC, rowid DESC LIMIT ?",
+                    (uid, anchor_ts, limit + 1),
+                ).fetchall()
+            else:
+                rows = conn.execute(
+                    f"SELECT id, ts, data FROM {collection} WHERE uid = ? ORDER BY ts DESC, rowid DESC LIMIT ?", (uid, limit + 1)
+                ).fetchall()
+        items = [_project_entry(entry_id, json.loads(data), fields) for entry_id, _ts, data in rows[:limit]]
+        return items, (encode_page_cursor(rows[limit - 1][1], rows[limit - 1][0]) if len(rows) > limit else None)
+
+    def get_entry(self, collection: str, uid: str, entry_id: str) -> dict | None:
+        rows = self._query(f"SELECT data FROM {collection} WHERE uid = ? AND id = ?", (uid, entry_id))
+        return {"id": entry_id, **json.loads(rows[0][0])} if rows else None
+
+    def _insert(self, conn: sqlite3.Connection, collection: str, uid: str, entries: list[dict], replace: bool = True) -> set[str]:
+        """Insert entries and return the ids actually written. Without ``replace`` an entry whose
+        id already exists is left untouched."""
+        timestamp_field = self.COLLECTIONS[collection]
+        verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+        written = set()
+        # Inserted oldest-first so that, within one timestamp, the first entry lists first.
+        for entry in reversed(entries):
+            entry_id = entry.get("id") or str(uuid4())
+            cursor = conn.execute(
+                f"{verb} INTO {collection} (id, uid, ts, analysis_id, data) VALUES (?, ?, ?, ?, ?)",
+                (entry_id, uid, str(entry.get(timestamp_field) or ""), entry.get("analysis_id"), json.dumps(entry)),
+            )
+            if cursor.rowcount:
+                written.add(entry_id)
+        limit = self.LIMITS.get(collection)
+        if limit:
+            conn.execute(
+                f"DELETE FROM {collection} WHERE uid = ? AND id NOT IN ("
+                f"SELECT id FROM {collection} WHERE uid = ? ORDER BY ts DESC, rowid DESC LIMIT ?)",
+                (uid, uid, limit),
+            )
+        return written
+
+    def add_entries(self, collection: str, uid: str, entries: list[dict], replace: bool = True) -> int:
+        """Add entries in one transaction and return how many were written."""
+        entries = [{**entry, "id": entry.get("id") or str(uuid4())} for entry in entries]
+        with self._transaction() as conn:
+            written = self._insert(conn, collection, uid, entries, replace=replace)
+            for entry in entries:
+                if entry["id"] in written:
+                    self._record(conn, uid, "add", collection, entry["id"], entry)
+            if collection == "feedback":
+                self._count_feedback(conn, [entry for entry in entries if entry["id"] in written])
+        return len(written)
+
+    def _count_feedback(self, conn: sqlite3.Connection, entries: list[dict]) -> None:
+        """Fold feedback into the per-recipe totals that back the popularity endpoint."""
+        for key, (name, by_type) in _feedback_counts(entries).items():
+            row = conn.execute("SELECT counts FROM feedback_totals WHERE recipe_key = ?", (key,)).fetchone()
+            counts = Counter(json.loads(row[0]) if row else {})
+            counts.update(by_type)
+            summary = _feedback_summary(name, counts)
+            conn.execute(
+                "INSERT OR REPLACE INTO feedback_totals (recipe_key, name, counts, score) VALUES (?, ?, ?, ?)",
+                (key, name, json.dumps(summary["counts"]), summary["score"]),
+            )
+
+    def popular_recipes(self, limit: int) -> dict:
+        def ranked(where: str, order: str) -> list[dict]:
+            rows = self._query(f"SELECT name, counts FROM feedback_totals WHERE {where} ORDER BY {order} LIMIT ?", (limit,))
+            return [_feedback_summary(name, json.loads(counts)) for name, counts in rows]
+
+        return {"top": ranked("score > 0", "score DESC"), "bottom": ranked("score < 0", "score ASC")}
+
+    def delete_entry(self, collection: str, uid: str, entry_id: str) -> None:
+        with self._transaction() as conn:
+            conn.execute(f"DELETE FROM {collection} WHERE uid = ? AND id = ?", (uid, entry_id))
+            self._record(conn, uid, "delete", collection, entry_id, None)
+
+    def _record(self, conn: sqlite3.Connection, uid: str, op: str, collection: str | None, doc_id: str | None, payload) -> None:
+        """Queue a mutation for replay to Firestore once it is reachable again. Only the newest
+        OUTBOX_MAX_ROWS are kept; older ones are dead-lettered."""
+        seq = conn.execute(
+            "INSERT INTO outbox (uid, op, collection, doc_id, payload, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (uid, op, collection, doc_id, json.dumps(payload), time.time()),
+        ).lastrowid
+        if seq > OUTBOX_MAX_ROWS:
+            self._dead_letter(conn, "seq <= ?", (seq - OUTBOX_MAX_ROWS,), "overflow")
+
+    def _dead_letter(self, conn: sqlite3.Connection, where: str, params: tuple, reason: str) -> int:
+        """Move outbox rows matching ``where`` to outbox_dead, where they stay for inspection."""
+        conn.execute(
+            "INSERT OR REPLACE INTO outbox_dead (seq, uid, op, collection, doc_id, payload, attempts, created_at, reason) "
+            f"SELECT seq, uid, op, collection, doc_id, payload, attempts, created_at, ? FROM outbox WHERE {where}",
+            (reason, *params),
+        )
+        moved = conn.execute(f"DELETE FROM outbox WHERE {where}", params).rowcount
+        if moved:
+            runtime_stats[f"outbox_dead_lettered_{reason}"] += moved
+            logger.warning(f"Dead-lettered {moved} local writes ({reason})")
+        return moved
+
+    def pending_writes(self, limit: int) -> list[tuple]:
+        rows = self._query("SELECT seq, uid, op, collection, doc_id, payload FROM outbox ORDER BY seq LIMIT ?", (limit,))
+        return [(*row[:5], json.loads(row[5])) for row in rows]
+
+    def clear_pending(self, up_to_seq: int) -> None:
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM outbox WHERE seq <= ?", (up_to_seq,))
+
+    def record_failed_replay(self, up_to_seq: int) -> None:
+        """Count a rejected replay against its rows; rows that keep failing are dead-lettered."""
+        with self._transaction() as conn:
+            conn.execute("UPDATE outbox SET attempts = attempts + 1 WHERE seq <= ?", (up_to_seq,))
+            self._dead_letter(conn, "attempts >= ?", (OUTBOX_MAX_ATTEMPTS,), "failed")
+
+    def prune_pending(self) -> None:
+        """Dead-letter rows that have waited longer than OUTBOX_MAX_AGE_SECONDS."""
+        with self._transaction() as conn:
+            self._dead_letter(conn, "created_at < ?", (time.time() - OUTBOX_MAX_AGE_SECONDS,), "expired")
+
+    def outbox_depth(self) -> dict:
+        pending = self._query("SELECT COUNT(*) FROM outbox", ())[0][0]
+        dead = self._query("SELECT COUNT(*) FROM outbox_dead", ())[0][0]
+        return {"pending": pending, "dead": dead}
+
+    def find_food_history(self, uid: str, analysis_id: str) -> dict | None:
+        rows = self._query(
+            "SELECT data FROM food_history WHERE uid = ? AND analysis_id = ? ORDER BY ts DESC LIMIT 1", (uid, analysis_id)
+        )
+        return json.loads(rows[0][0]) if rows else None
+
+    def _migrate_json_files(self) -> None:
+        """One-shot import of the legacy per-user JSON files; each is renamed once imported."""
+        for path in sorted(self.path.parent.glob("*.json")):
+            try:
+                data = json.loads(path.read_text(encoding="utf-8"))
+                if not isinstance(data, dict):
+                    raise ValueError("not a user store")
+                uid = path.stem
+                profile = data.get("profile") if isinstance(data.get("profile"), dict) else {}
+                preferences = data.get("preferences") if isinstance(data.get("preferences"), dict) else {}
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO users (uid, profile, preferences) VALUES (?, ?, ?)",
+                        (uid, json.dumps(profile), json.dumps({**DEFAULT_PREFERENCES, **preferences})),
+                    )
+                    for collection in self.COLLECTIONS:
+                        entries = data.get(collection)
+                        if isinstance(entries, list):
+                            self._insert(self._conn, collection, uid, [e for e in entries if isinstance(e, dict)])
+                except BaseException:
+                    self._conn.execute("ROLLBACK")
+                    raise
+                self._conn.execute("COMMIT")
+                path.rename(path.with_name(path.name + ".migrated"))
+                runtime_stats["local_store_migrated_files"] += 1
+            except Exception as e:
+                logger.warning(f"Could not migrate local store file {path.name}: {e}")
 
 
-def _write_user_store(uid: str, data: dict) -> None:
-    _ensure_local_store_dir()
-    path = _user_store_path(uid)
-    with path.open("w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
+local_store = LocalUserStore(LOCAL_DATA_DIR / "user_store.sqlite3")
 
 
 def _now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
 
-def ensure_runtime_ready():
-    if INIT_ERROR:
-        raise HTTPException(status_code=500, detail=f"Backend configuration error: {INIT_ERROR}")
+def get_genai_client():
+    try:
+        return genai_client.get()
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=f"Backend configuration error: {exc}")
+
+
+class IdTokenVerifier:
+    """Verifies Firebase ID tokens against locally held signing certificates.
 
+    Verified tokens are cached by hash until their ``exp``, so each token's signature is checked
+    once rather than on every request. Certificates are refreshed in the background ahead of
+    their Cache-Control expiry; until they are available (or for an unknown key id, or under
+    the Auth emulator) verification falls back to the Admin SDK off the event loop.
+    """
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    def __init__(self, project_id: str | None, maxsize: int):
+        self.project_id = project_id
+        self.issuer = f"https://securetoken.google.com/{project_id}"
+        self._tokens = TTLCache(maxsize, 3600)
+        self._certs: dict = {}
+        self._certs_expire_at = 0.0
+        self._refresh_task: asyncio.Task | None = None
+        self._use_local_keys = bool(project_id) and not os.getenv("FIREBASE_AUTH_EMULATOR_HOST")
+
+    async def refresh_certs(self) -> float:
+        """Fetch the current signing certificates; returns their lifetime in seconds."""
+        response = await get_http_client().get(FIREBASE_CERTS_URL)
+        response.raise_for_status()
+        match = re.search(r"max-age=(\d+)", response.headers.get("cache-control", ""))
+        max_age = float(match.group(1)) if match else 3600.0
+        self._certs = response.json()
+        self._certs_expire_at = time.time() + max_age
+        runtime_stats["auth_cert_refreshes"] += 1
+        return max_age
+
+    async def _refresh_quietly(self) -> float | None:
+        try:
+            return await self.refresh_certs()
+        except Exception as e:
+            logger.warning(f"Firebase certificate refresh failed: {e}")
+            runtime_stats["auth_cert_refresh_failures"] += 1
+            return None
+
+    async def run_refresh_loop(self) -> None:
+        """Keep certificates fresh for the lifetime of the app."""
+        while True:
+            max_age = await self._refresh_quietly()
+            await asyncio.sleep(max(60.0, max_age - AUTH_CERT_REFRESH_MARGIN_SECONDS) if max_age else 30.0)
+
+    def _schedule_refresh(self) -> None:
+        if not self._use_local_keys or time.time() < self._certs_expire_at - AUTH_CERT_REFRESH_MARGIN_SECONDS:
+            return
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh_quietly())
+
+    def _verify_locally(self, token: str) -> dict | None:
+        header = google_jwt.decode_header(token)
+        if header.get("alg") != "RS256" or header.get("kid") not in self._certs:
+            return None
+        claims = google_jwt.decode(token, certs=self._certs, audience=self.project_id)
+        subject = claims.get("sub")
+        if claims.get("iss") != self.issuer or not isinstance(subject, str) or not subject or len(subject) > 128:
+            raise ValueError("Token issuer or subject is invalid")
+        return claims
+
+    async def verify(self, token: str) -> str | None:
+        key = hashlib.sha256(token.encode("utf-8")).hexdigest()
+        cached = self._tokens.get(key)
+        if cached is not None and cached[1] > time.time():
+            runtime_stats["auth_token_cache_hits"] += 1
+            return cached[0]
+        runtime_stats["auth_token_cache_misses"] += 1
+        self._schedule_refresh()
+        try:
+            claims = None
+            if self._use_local_keys and time.time() < self._certs_expire_at:
+                claims = self._verify_locally(token)
+            if claims is None:
+                runtime_stats["auth_sdk_verifications"] += 1
+                firebase_app.get()
+                claims = await asyncio.to_thread(auth.verify_id_token, token)
+        except Exception:
+            runtime_stats["auth_token_rejected"] += 1
+            return None
+        expires_at = float(claims.get("exp", 0))
+        if expires_at > time.time():
+            self._tokens.set(key, (claims["sub"], expires_at), ttl=expires_at - time.time())
+        return claims["sub"]
+
+
+id_token_verifier = IdTokenVerifier(project_id, AUTH_TOKEN_CACHE_SIZE)
+
+
+# Whether the current request is from a signed-in user; the model gate serves those first.
+caller_signed_in: ContextVar[bool] = ContextVar("caller_signed_in", default=False)
+
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     if not credentials:
         return None
-    try:
-        decoded_token = auth.verify_id_token(credentials.credentials)
-        return decoded_token["uid"]
-    except Exception:
-        return None
+    with stage("auth"):
+        uid = await id_token_verifier.verify(credentials.credentials)
+    caller_signed_in.set(uid is not None)
+    return uid
 
 
-def require_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    uid = get_current_user(credentials)
+async def require_user(request: Request, uid: str | None = Depends(get_current_user)):
     if not uid:
         raise HTTPException(status_code=401, detail="Authentication required")
+    await enforce_rate_limit(request, "crud", uid)
     return uid
 
 
-def get_user_preferences(uid: str | None) -> dict:
+_db_loop: asyncio.AbstractEventLoop | None = None
+
+
+def get_db():
+    """Async Firestore client for the running event loop. Rebuilt if the runtime hands us a
+    different loop, since its gRPC channel is loop-bound (same as the HTTP client)."""
+    global db, _db_loop
+    loop = asyncio.get_running_loop()
+    if db is None or _db_loop is not loop:
+        # Firebase is resolved here and in token verification only, so guest routes never need it.
+        try:
+            app = firebase_app.get()
+        except Exception as exc:
+            raise HTTPException(status_code=500, detail=f"Backend configuration error: {exc}")
+        db = firestore.AsyncClient(credentials=app.credential.get_credential(), project=app.project_id)
+        _db_loop = loop
+    return db
+
+
+class CircuitBreaker:
+    """Closed -> open after ``failure_threshold`` consecutive outage errors. While open, calls
+    are refused until ``reset_timeout`` has passed; then a single probe is let through
+    (half-open), which closes the circuit on success or re-opens it on failure. A probe that
+    has not reported back within ``probe_timeout`` (cancelled or hung) no longer blocks the
+    next one."""
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float, probe_timeout: float = 5.0, on_close=None):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.probe_timeout = probe_timeout
+        self.on_close = on_close
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started = 0.0
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        now = time.monotonic()
+        if (self.state == "open" and now >= self.opened_at + self.reset_timeout) or (
+            self.state == "half_open" and now >= self.probe_started + self.probe_timeout
+        ):
+            self.state = "half_open"
+            self.probe_started = now
+            runtime_stats[f"{self.name}_breaker_probes"] += 1
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        if self.state != "closed":
+            self.state = "closed"
+            runtime_stats[f"{self.name}_breaker_closed"] += 1
+            if self.on_close is not None:
+                self.on_close()
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            runtime_stats[f"{self.name}_breaker_opened"] += 1
+
+
+class FirestoreCircuitOpen(Exception):
+    """Raised instead of calling Firestore while the breaker is open and there is no fallback."""
+
+
+class UserRepository:
+    """Async data access for everything stored under ``users/{uid}``.
+
+    Handlers go through this class rather than touching Firestore directly, so one worker can
+    overlap many reads and writes. When Firestore is unavailable each method falls back to the
+    local store with the same semantics as before; any other error propagates to the caller.
+    Calls are guarded by a circuit breaker, so during an outage requests go straight to the
+    local store instead of paying Firestore's failure latency first.
+    """
+
+    _TIMESTAMP_FIELDS = {"food_history": "analyzed_at", "feedback": "created_at"}
+
+    def __init__(self, client_factory, breaker: CircuitBreaker):
+        self._client_factory = client_factory
+        self.breaker = breaker
+
+    def _user(self, uid: str):
+        return self._client_factory().collection("users").document(uid)
+
+    async def _call(self, remote, local=None):
+        """Run ``remote()`` against Firestore, or the blocking ``local()`` in a thread when
+        Firestore is unavailable or the breaker is open. Without ``local`` the error is raised."""
+        if not self.breaker.allow():
+            runtime_stats["firestore_short_circuits"] += 1
+            if local is None:
+                raise FirestoreCircuitOpen("Firestore circuit breaker is open")
+            return await asyncio.to_thread(local)
+        probe = self.breaker.state == "half_open"
+        try:
+            if probe:
+                result = await asyncio.wait_for(remote(), timeout=self.breaker.probe_timeout)
+            else:
+                result = await remote()
+        except Exception as e:
+            # A probe that times out counts as Firestore still being down.
+            unavailable = _is_firestore_unavailable(e) or (probe and isinstance(e, asyncio.TimeoutError))
+            # Other errors (a bad query, a configuration error) say nothing about Firestore's
+            # health, so they leave the breaker as it is; a probe that hits one stays unanswered.
+            if unavailable or _is_transient_firestore_error(e):
+                self.breaker.record_failure()
+            if local is not None and unavailable:
+                return await asyncio.to_thread(local)
+            raise
+        except BaseException:
+            # Cancelled mid-probe: re-open rather than leave the breaker half-open.
+            if probe:
+                self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return result
+
+    async def get_user(self, uid: str) -> dict | None:
+        async def remote():
+            doc = await self._user(uid).get()
+            return doc.to_dict() if doc.exists else None
+
+        return await self._call(remote, lambda: {"uid": uid, **local_store.get_user(uid)})
+
+    async def update_profile(self, uid: str, data: dict) -> None:
+        incoming_profile = data.get("profile", {}) if isinstance(data, dict) else {}
+        await self._call(
+            lambda: self._user(uid).set(data, merge=True),
+            lambda: local_store.merge_profile(uid, incoming_profile),
+        )
+
+    async def set_preferences(self, uid: str, prefs: dict) -> dict:
+        """Store preferences and return them as they were saved."""
+        async def remote():
+            await self._user(uid).set({"preferences": prefs}, merge=True)
+            return prefs
+
+        return await self._call(remote, lambda: local_store.set_preferences(uid, prefs))
+
+    async def list_page(self, collection: str, uid: str, limit: int, after: str | None = None, fields: list[str] | None = None) -> tuple[list[dict], str | None]:
+        """Newest-first page of a subcollection, starting after the document with id ``after``.
+        ``fields`` projects each document server-side. Returns the page and the next cursor."""
+        timestamp_field = LocalUserStore.COLLECTIONS[collection]
+        anchor_ts, anchor_id = decode_page_cursor(after) if after else (None, None)
+
+        async def remote():
+            ref = self._user(uid).collection(collection)
+            query = ref.order_by(timestamp_field, direction=firestore.Query.DESCENDING)
+            if fields is not None:
+                query = query.select(list(dict.fromkeys([*fields, timestamp_field])))
+            if anchor_id:
+                anchor = await ref.document(anchor_id).get()
+                if anchor.exists:
+                    query = query.start_after(anchor)
+                elif anchor_ts:
+                    # Cursor from the local store for an entry Firestore does not have (yet).
+                    query = query.start_after({timestamp_field: datetime.fromisoformat(anchor_ts)})
+            docs = [doc async for doc in query.limit(limit + 1).stream()]
+            items = [_project_entry(doc.id, doc.to_dict(), fields) for doc in docs[:limit]]
+            if len(docs) <= limit:
+                return items, None
+            last = docs[limit - 1]
+            return items, encode_page_cursor(last.to_dict().get(timestamp_field), last.id)
+
+        return await self._call(remote, lambda: local_store.list_page(collection, uid, limit, after, fields))
+
+    async def get_entry(self, collection: str, uid: str, entry_id: str) -> dict | None:
+        async def remote():
+            doc = await self._user(uid).collection(collection).document(entry_id).get()
+            return {"id": doc.id, **doc.to_dict()} if doc.exists else None
+
+        return await self._call(remote, lambda: local_store.get_entry(collection, uid, entry_id))
+
+    async def add_saved_recipe(self, uid: str, recipe: dict) -> str:
+        """Save a recipe under its content hash. Saving a recipe that is already saved is a
+        no-op that returns the existing id."""
+        recipe = {key: value for key, value in recipe.items() if key not in ("id", "saved_at")}
+        saved_id = saved_recipe_id(recipe)
+
+        async def remote():
+            try:
+                await self._user(uid).collection("saved_recipes").document(saved_id).create(
+                    {**recipe, "saved_at": firestore.SERVER_TIMESTAMP}
+                )
+            except GoogleAlreadyExists:
+                runtime_stats["saved_recipe_duplicates"] += 1
+            return saved_id
+
+        def local():
+            if not local_store.add_entries("saved_recipes", uid, [{**recipe, "id": saved_id, "saved_at": _now_iso()}], replace=False):
+                runtime_stats["saved_recipe_duplicates"] += 1
+            return saved_id
+
+        return await self._call(remote, local)
+
+    async def add_saved_recipes(self, uid: str, recipes: list[dict]) -> tuple[list[str], int]:
+        """Save several recipes in one batched commit. Returns the id of every recipe, in
+        request order, and how many of them were not saved before."""
+        recipes = [{key: value for key, value in recipe.items() if key not in ("id", "saved_at")} for recipe in recipes]
+        ids = [saved_recipe_id(recipe) for recipe in recipes]
+        unique = dict(zip(ids, recipes))
+
+        async def remote():
+            client = self._client_factory()
+            ref = self._user(uid).collection("saved_recipes")
+            refs = [ref.document(saved_id) for saved_id in unique]
+            existing = {snapshot.id async for snapshot in client.get_all(refs, field_paths=["saved_at"]) if snapshot.exists}
+            batch = client.batch()
+            created = 0
+            for doc_ref in refs:
+                if doc_ref.id not in existing:
+                    # ``set`` rather than ``create``: a concurrent save of the same content
+                    # writes identical fields, and one conflict must not fail the whole batch.
+                    batch.set(doc_ref, {**unique[doc_ref.id], "saved_at": firestore.SERVER_TIMESTAMP})
+                    created += 1
+            if created:
+                await batch.commit()
+            return created
+
+        def local():
+            now = _now_iso()
+            entries = [{**recipe, "id": saved_id, "saved_at": now} for saved_id, recipe in unique.items()]
+            return local_store.add_entries("saved_recipes", uid, entries, replace=False)
+
+        created = await self._call(remote, local)
+        runtime_stats["saved_recipe_duplicates"] += len(ids) - created
+        return ids, created
+
+    async def delete_saved_recipe(self, uid: str, recipe_id: str) -> None:
+        await self._call(
+            lambda: self._user(uid).collection("saved_recipes").document(recipe_id).delete(),
+            lambda: local_store.delete_entry("saved_recipes", uid, recipe_id),
+        )
+
+    async def append_entries(self, writes: list[tuple[str, str, dict]], fallback: bool = True) -> None:
+        """Append ``(collection, uid, fields)`` entries to per-user subcollections such as
+        ``food_history`` and ``feedback`` in one batched commit, stamping each with the server
+        time. With ``fallback`` the entries go to the local store when Firestore is unavailable."""
+        async def remote():
+            batch = self._client_factory().batch()
+            for collection, uid, fields in writes:
+                timestamp_field = self._TIMESTAMP_FIELDS[collection]
+                batch.set(self._user(uid).collection(collection).document(), {**fields, timestamp_field: firestore.SERVER_TIMESTAMP})
+            counts = _feedback_counts(fields for collection, _uid, fields in writes if collection == "feedback")
+            self._add_feedback_increments(batch, counts)
+            await batch.commit()
+            feedback_rollup.mark(counts)
+
+        await self._call(remote, (lambda: self.append_entries_locally(writes)) if fallback else None)
+
+    def _add_feedback_increments(self, batch, counts: dict[str, tuple[str, Counter]]) -> None:
+        """Add feedback to a random shard of each recipe's counters, so popular recipes do not
+        turn one counter document into a write hotspot."""
+        for key, (name, by_type) in counts.items():
+            shard = (
+                self._client_factory().collection("recipe_feedback").document(key)
+                .collection("shards").document(str(random.randrange(FEEDBACK_COUNTER_SHARDS)))
+            )
+            batch.set(shard, {"name": name, "counts": {t: firestore.Increment(n) for t, n in by_type.items()}}, merge=True)
+
+    async def rollup_feedback_counters(self, keys: list[str]) -> None:
+        """Sum each recipe's counter shards into its summary document in ``recipe_feedback``,
+        which is what the popularity queries read."""
+        async def remote():
+            client = self._client_factory()
+            batch = client.batch()
+            for key in keys:
+                ref = client.collection("recipe_feedback").document(key)
+                name, counts = None, Counter()
+                async for shard in ref.collection("shards").stream():
+                    data = shard.to_dict() or {}
+                    name = data.get("name", name)
+                    counts.update({t: int(n) for t, n in (data.get("counts") or {}).items()})
+                if name is not None:
+                    batch.set(ref, {**_feedback_summary(name, counts), "updated_at": firestore.SERVER_TIMESTAMP})
+            await batch.commit()
+
+        await self._call(remote)
+
+    async def popular_recipes(self, limit: int) -> dict:
+        """Top and bottom recipes by feedback score, read from the rolled-up summaries."""
+        async def remote():
+            ref = self._client_factory().collection("recipe_feedback").select(FEEDBACK_SUMMARY_FIELDS)
+            top = ref.where("score", ">", 0).order_by("score", direction=firestore.Query.DESCENDING).limit(limit)
+            bottom = ref.where("score", "<", 0).order_by("score").limit(limit)
+            return {
+                "top": [doc.to_dict() async for doc in top.stream()],
+                "bottom": [doc.to_dict() async for doc in bottom.stream()],
+            }
+
+        return await self._call(remote, lambda: local_store.popular_recipes(limit))
+
+    def append_entries_locally(self, writes: list[tuple[str, str, dict]]) -> None:
+        grouped: dict[tuple[str, str], list[dict]] = {}
+        for collection, uid, fields in writes:
+            entry = {"id": str(uuid4()), **fields, self._TIMESTAMP_FIELDS[collection]: _now_iso()}
+            grouped.setdefault((collection, uid), []).append(entry)
+        for (collection, uid), entries in grouped.items():
+            local_store.add_entries(collection, uid, entries)
+
+    async def find_food_history(self, uid: str, analysis_id: str) -> dict | None:
+        async def remote():
+            query = self._user(uid).collection("food_history").where("analysis_id", "==", analysis_id).limit(1)
+            async for doc in query.stream():
+                return doc.to_dict()
+            return None
+
+        return await self._call(remote, lambda: local_store.find_food_history(uid, analysis_id))
+
+    async def replay_local_writes(self, writes: list[tuple]) -> int:
+        """Apply outbox rows ``(seq, uid, op, collection, doc_id, payload)`` to Firestore in one
+        batch. Stops before a document would be written twice; returns how many rows were applied."""
+        async def remote():
+            batch = self._client_factory().batch()
+            touched = set()
+            applied = 0
+            feedback = []
+            for _seq, uid, op, collection, doc_id, payload in writes:
+                if (uid, collection, doc_id) in touched:
+                    break
+                touched.add((uid, collection, doc_id))
+                ref = self._user(uid).collection(collection).document(doc_id) if collection else self._user(uid)
+                if op == "merge_profile":
+                    batch.set(ref, {"profile": payload}, merge=True)
+                elif op == "set_preferences":
+                    batch.set(ref, {"preferences": payload}, merge=True)
+                elif op == "add":
+                    batch.set(ref, _firestore_entry(collection, payload))
+                    if collection == "feedback":
+                        feedback.append(payload)
+                elif op == "delete":
+                    batch.delete(ref)
+                applied += 1
+            counts = _feedback_counts(feedback)
+            self._add_feedback_increments(batch, counts)
+            await batch.commit()
+            feedback_rollup.mark(counts)
+            return applied
+
+        return await self._call(remote)
+
+
+def _firestore_entry(collection: str, entry: dict) -> dict:
+    """Convert a locally stored entry back into Firestore document fields."""
+    document = {key: value for key, value in entry.items() if key != "id"}
+    timestamp_field = LocalUserStore.COLLECTIONS[collection]
+    try:
+        document[timestamp_field] = datetime.fromisoformat(document[timestamp_field])
+    except (KeyError, TypeError, ValueError):
+        pass
+    return document
+
+
+firestore_breaker = CircuitBreaker(
+    "firestore",
+    FIRESTORE_BREAKER_FAILURES,
+    FIRESTORE_BREAKER_RESET_SECONDS,
+    probe_timeout=FIRESTORE_PROBE_TIMEOUT_SECONDS,
+    on_close=lambda: local_reconciler.schedule(),
+)
+user_repository = UserRepository(get_db, firestore_breaker)
+
+
+class WriteBehindQueue:
+    """Takes food-history and feedback appends off the response path.
+
+    Entries are coalesced into one Firestore batch per flush (up to ``batch_size`` entries or
+    every ``interval`` seconds). Transient errors are retried with backoff; entries that still
+    cannot be committed, or that arrive while the queue is full or stopped, are written
+    directly (falling back to the local store as usual). ``drain()`` flushes what is left on
+    shutdown.
+    """
+
+    def __init__(self, repository: UserRepository, batch_size: int, interval: float, max_size: int):
+        self.repository = repository
+        self.batch_size = max(1, min(batch_size, 500))
+        self.interval = interval
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_size)
+        self._inflight: list = []
+        self._worker: asyncio.Task | None = None
+
+    def start(self) -> None:
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    async def submit(self, writes: list[tuple[str, str, dict]]) -> None:
+        if self._worker is None or self._worker.done():
+            await self.repository.append_entries(writes)
+            return
+        for index, write in enumerate(writes):
+            try:
+                self._queue.put_nowait(write)
+            except asyncio.QueueFull:
+                runtime_stats["write_behind_overflow"] += len(writes) - index
+                await self.repository.append_entries(writes[index:])
+                return
+        runtime_stats["write_behind_enqueued"] += len(writes)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            self._inflight = [await self._queue.get()]
+            deadline = loop.time() + self.interval
+            while len(self._inflight) < self.batch_size:
+                try:
+                    self._inflight.append(await asyncio.wait_for(self._queue.get(), max(0.0, deadline - loop.time())))
+                except asyncio.TimeoutError:
+                    break
+            await self._flush(self._inflight)
+            for _ in self._inflight:
+                self._queue.task_done()
+            self._inflight = []
+
+    async def _flush(self, writes: list) -> None:
+        for attempt in range(WRITE_BEHIND_MAX_ATTEMPTS):
+            try:
+                await self.repository.append_entries(writes, fallback=False)
+                runtime_stats["write_behind_committed"] += len(writes)
+                runtime_stats["write_behind_batches"] += 1
+                return
+            except Exception as e:
+                if not _is_transient_firestore_error(e) or attempt == WRITE_BEHIND_MAX_ATTEMPTS - 1:
+                    logger.warning(f"Write-behind flush of {len(writes)} entries failed, spilling to local store: {e}")
+                    break
+                runtime_stats["write_behind_retries"] += 1
+                await asyncio.sleep(0.2 * 2 ** attempt)
+        await self._spill(writes)
+
+    async def _spill(self, writes: list) -> None:
+        try:
+            await asyncio.to_thread(self.repository.append_entries_locally, writes)
+            runtime_stats["write_behind_spilled"] += len(writes)
+        except Exception as e:
+            logger.warning(f"Could not spill {len(writes)} entries to the local store: {e}")
+            runtime_stats["write_behind_dropped"] += len(writes)
+
+    async def drain(self, timeout: float) -> None:
+        """Stop accepting entries and flush whatever is queued; spill the rest on timeout."""
+        worker, self._worker = self._worker, None
+        if worker is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        worker.cancel()
+        leftover = list(self._inflight)
+        while not self._queue.empty():
+            leftover.append(self._queue.get_nowait())
+            self._queue.task_done()
+        if leftover:
+            await self._spill(leftover)
+
+
+write_behind = WriteBehindQueue(user_repository, WRITE_BEHIND_BATCH_SIZE, WRITE_BEHIND_INTERVAL_SECONDS, WRITE_BEHIND_MAX_QUEUE)
+
+
+class LocalWriteReconciler:
+    """Replays writes that landed in the local store during a Firestore outage (saved recipes,
+    history, feedback, profile and preferences) back to Firestore, oldest first. Runs when the
+    breaker closes again and periodically while the app is up; replay is idempotent, so rows
+    are only cleared after their batch has committed. A batch that Firestore rejects for any
+    reason other than an outage counts against its rows, and each run first dead-letters rows
+    past OUTBOX_MAX_AGE_SECONDS, so a lasting outage or a bad row cannot grow the outbox forever."""
+
+    def __init__(self, repository: UserRepository, store: LocalUserStore, batch_size: int = 200):
+        self.repository = repository
+        self.store = store
+        self.batch_size = batch_size
+        self._task: asyncio.Task | None = None
+
+    def schedule(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run_once())
+
+    async def run_once(self) -> int:
+        await asyncio.to_thread(self.store.prune_pending)
+        replayed = 0
+        while self.repository.breaker.state == "closed":
+            rows = await asyncio.to_thread(self.store.pending_writes, self.batch_size)
+            if not rows:
+                break
+            try:
+                applied = await self.repository.replay_local_writes(rows)
+            except Exception as e:
+                logger.warning(f"Could not replay local writes to Firestore: {e}")
+                runtime_stats["reconcile_failures"] += 1
+                if not (isinstance(e, FirestoreCircuitOpen) or _is_firestore_unavailable(e) or _is_transient_firestore_error(e)):
+                    await asyncio.to_thread(self.store.record_failed_replay, rows[-1][0])
+                break
+            await asyncio.to_thread(self.store.clear_pending, rows[applied - 1][0])
+            replayed += applied
+            runtime_stats["reconciled_writes"] += applied
+        return replayed
+
+    async def run_loop(self) -> None:
+        while True:
+            await asyncio.sleep(RECONCILE_INTERVAL_SECONDS)
+            await self.run_once()
+
+
+local_reconciler = LocalWriteReconciler(user_repository, local_store)
+
+
+class FeedbackRollup:
+    """Tracks recipes whose counter shards changed and periodically folds them into their
+    summary documents. Marks are per process; a failed roll-up keeps its recipes pending."""
+
+    def __init__(self, repository: UserRepository):
+        self.repository = repository
+        self._pending: set[str] = set()
+
+    def mark(self, keys) -> None:
+        self._pending.update(keys)
+
+    async def run_once(self) -> int:
+        keys, self._pending = self._pending, set()
+        if not keys:
+            return 0
+        try:
+            await self.repository.rollup_feedback_counters(sorted(keys))
+        except Exception as e:
+            logger.warning(f"Could not roll up feedback counters: {e}")
+            runtime_stats["feedback_rollup_failures"] += 1
+            self._pending.update(keys)
+            return 0
+        runtime_stats["feedback_rollups"] += len(keys)
+        popular_recipes_cache.clear()
+        return len(keys)
+
+    async def run_loop(self) -> None:
+        while True:
+            await asyncio.sleep(FEEDBACK_ROLLUP_INTERVAL_SECONDS)
+            await self.run_once()
+
+
+feedback_rollup = FeedbackRollup(user_repository)
+popular_recipes_cache = TTLCache(POPULAR_RECIPES_MAX_LIMIT, POPULAR_RECIPES_CACHE_TTL_SECONDS)
+
+
+preferences_cache = TTLCache(PREFERENCES_CACHE_SIZE, PREFERENCES_CACHE_TTL_SECONDS)
+_redis_client = None
+_redis_client_loop: asyncio.AbstractEventLoop | None = None
+
+
+def get_redis_client():
+    """Shared preference cache across workers when REDIS_URL is set and redis is installed.
+    When it is, the in-process tier is bypassed so writes are seen by every worker."""
+    global _redis_client, _redis_client_loop
+    if not REDIS_URL or aioredis is None:
+        return None
+    loop = asyncio.get_running_loop()
+    if _redis_client is None or _redis_client_loop is not loop:
+        _redis_client = aioredis.from_url(REDIS_URL, decode_responses=True, socket_timeout=0.5)
+        _redis_client_loop = loop
+    return _redis_client
+
+
+def _preferences_redis_key(uid: str) -> str:
+    return f"nutrisnap:preferences:{uid}"
+
+
+async def _get_cached_preferences(uid: str) -> dict | None:
+    redis = get_redis_client()
+    if redis is None:
+        return preferences_cache.get(uid)
+    try:
+        raw = await redis.get(_preferences_redis_key(uid))
+    except Exception as e:
+        logger.warning(f"Preference cache read failed for {uid}: {e}")
+        runtime_stats["preferences_cache_errors"] += 1
+        return None
+    return json.loads(raw) if raw else None
+
+
+async def _set_cached_preferences(uid: str, prefs: dict, replace: bool = True) -> None:
+    """Writes cache what they saved (``replace``). Reads only fill an empty entry, so a read that
+    started before a write can never put the older preferences back over the newer ones."""
+    redis = get_redis_client()
+    if redis is None:
+        if replace or preferences_cache.get(uid) is None:
+            preferences_cache.set(uid, prefs)
+        return
+    try:
+        await redis.set(_preferences_redis_key(uid), json.dumps(prefs), ex=int(PREFERENCES_CACHE_TTL_SECONDS), nx=not replace)
+    except Exception as e:
+        logger.warning(f"Preference cache write failed for {uid}: {e}")
+        runtime_stats["preferences_cache_errors"] += 1
+
+
+@timed("prefs")
+async def get_user_preferences(uid: str | None) -> dict:
     if not uid:
         return DEFAULT_PREFERENCES
+    cached = await _get_cached_preferences(uid)
+    if cached is not None:
+        runtime_stats["preferences_cache_hits"] += 1
+        return cached
+    runtime_stats["preferences_cache_misses"] += 1
     try:
-        doc = db.collection("users").document(uid).get()
-        if doc.exists:
-            data = doc.to_dict()
-            prefs = data.get("preferences", {})
-            return {**DEFAULT_PREFERENCES, **prefs}
+        user = await user_repository.get_user(uid)
+        prefs = DEFAULT_PREFERENCES
+        if user is not None:
+            prefs = user.get("preferences") or {}
+            prefs = {**DEFAULT_PREFERENCES, **prefs}
+        await _set_cached_preferences(uid, prefs, replace=False)
+        return prefs
     except Exception as e:
-        if _is_firestore_unavailable(e):
-            local = _read_user_store(uid)
-            return {**DEFAULT_PREFERENCES, **(local.get("preferences") or {})}
-        print(f"Could not fetch preferences for {uid}: {e}")
+        logger.warning(f"Could not fetch preferences for {uid}: {e}")
     return DEFAULT_PREFERENCES
 
 
-def build_prompt(prefs: dict) -> str:
-    return f"""
-    You are NutriSnap AI, an advanced multimodal nutrition and cooking assistant built to help users create healthy meals from available ingredients.
+RATE_LIMIT_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = math.min(capacity, (tonumber(state[1]) or capacity) + math.max(0, now - (tonumber(state[2]) or now)) * rate)
+local wait = 0
+if tokens >= cost then
+  tokens = tokens - cost
+else
+  wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RateLimiter:
+    """Token buckets per caller and budget ("model" or "crud"), with separate sizes for
+    signed-in users and guests. Buckets live in Redis when REDIS_URL is set, so limits hold
+    across workers; otherwise, or while Redis is failing, they are kept per process."""
+
+    def __init__(self, budgets: dict[tuple[str, bool], tuple[float, float]], max_buckets: int):
+        self.budgets = budgets
+        self._buckets = TTLCache(max_buckets, max(capacity / rate for capacity, rate in budgets.values()))
+        self._script = None
+
+    def _take_local(self, key: str, capacity: float, rate: float, cost: float) -> float:
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        wait = 0.0 if tokens >= cost else (cost - tokens) / rate
+        self._buckets.set(key, (tokens if wait else tokens - cost, now))
+        return wait
+
+    async def _take_shared(self, redis, key: str, capacity: float, rate: float, cost: float) -> float:
+        if self._script is None or self._script.registered_client is not redis:
+            self._script = redis.register_script(RATE_LIMIT_SCRIPT)
+        return float(await self._script(keys=[key], args=[capacity, rate, time.time(), cost]))
+
+    def capacity(self, kind: str, signed_in: bool) -> float:
+        return self.budgets[(kind, signed_in)][0]
+
+    async def take(self, kind: str, caller: str, signed_in: bool, cost: float = 1) -> float:
+        """Spend ``cost`` tokens from the caller's bucket. Returns 0 when the call is allowed,
+        otherwise the seconds until enough tokens are back. ``cost`` must fit in the bucket."""
+        capacity, rate = self.budgets[(kind, signed_in)]
+        if cost > capacity:
+            raise ValueError(f"cost {cost} exceeds the {kind} bucket size {capacity}")
+        key = f"ratelimit:{kind}:{caller}"
+        redis = get_redis_client()
+        if redis is not None:
+            try:
+                return await self._take_shared(redis, key, capacity, rate, cost)
+            except Exception as e:
+                runtime_stats["rate_limit_store_errors"] += 1
+                logger.warning(f"Rate limit store unavailable, using in-process buckets: {e}")
+        return self._take_local(key, capacity, rate, cost)
+
+
+rate_limiter = RateLimiter(
+    {
+        ("model", True): (RATE_LIMIT_MODEL_BURST, RATE_LIMIT_MODEL_PER_MINUTE / 60),
+        ("model", False): (RATE_LIMIT_GUEST_MODEL_BURST, RATE_LIMIT_GUEST_MODEL_PER_MINUTE / 60),
+        ("crud", True): (RATE_LIMIT_CRUD_BURST, RATE_LIMIT_CRUD_PER_MINUTE / 60),
+        ("crud", False): (RATE_LIMIT_GUEST_CRUD_BURST, RATE_LIMIT_GUEST_CRUD_PER_MINUTE / 60),
+    },
+    RATE_LIMIT_MAX_BUCKETS,
+)
 
-    Your task is to analyze an image of food ingredients and generate healthy, personalized recipe suggestions.
 
-    ### USER PROFILE & PREFERENCES
-    Tailor ALL recipes strictly to this user's profile:
-    - Health Goal: {prefs['health_goal']}
-    - Diet Type: {prefs['diet_type']}
-    - Allergies / Restrictions: {prefs['allergies']}
-    - Cooking Time Preference: {prefs['cooking_time']}
-    - Cuisine Preferences: {prefs['cuisine_preferences']}
-    - Calorie Target: {prefs['calorie_target']}
-    - Fitness Goal: {prefs['fitness_goal']}
+def client_ip(request: Request) -> str:
+    if RATE_LIMIT_TRUST_FORWARDED:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+
+async def enforce_rate_limit(request: Request, kind: str, uid: str | None, cost: int = 1) -> None:
+    """Raise 429 with Retry-After once the caller (uid, or client IP for guests) has spent its
+    ``kind`` budget. A request costing more than the whole bucket is refused with 413, since
+    waiting would never let it through."""
+    if not RATE_LIMIT_ENABLED:
+        return
+    signed_in = uid is not None
+    capacity = rate_limiter.capacity(kind, signed_in)
+    if cost > capacity:
+        runtime_stats[f"rate_limited_{kind}"] += 1
+        raise HTTPException(
+            status_code=413,
+            detail=f"Too many items in one request; at most {int(capacity)} are allowed. Please split it up.",
+        )
+    caller = f"user:{uid}" if uid else f"ip:{client_ip(request)}"
+    wait = await rate_limiter.take(kind, caller, signed_in, cost)
+    if wait > 0:
+        runtime_stats[f"rate_limited_{kind}"] += 1
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests. Please wait a moment and try again.",
+            headers={"Retry-After": str(math.ceil(wait))},
+        )
+
+
+async def limit_model_calls(request: Request, uid: str | None = Depends(get_current_user)) -> None:
+    await enforce_rate_limit(request, "model", uid)
+
+
+async def limit_crud_calls(request: Request, uid: str | None = Depends(get_current_user)) -> None:
+    await enforce_rate_limit(request, "crud", uid)
+
+
+class ModelGate:
+    """Bounds in-flight Gemini calls and sheds load once the wait queue is full. Signed-in
+    callers are admitted ahead of guests; guests are shed once ``max_guest_queue`` calls are
+    waiting, and a signed-in caller arriving at a full queue takes the newest guest's place."""
+
+    def __init__(self, max_in_flight: int, max_queue: int, max_guest_queue: int):
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queue = max(0, max_queue)
+        self.max_guest_queue = min(self.max_queue, max(0, max_guest_queue))
+        self.in_flight = 0
+        self._waiters: dict[bool, deque] = {True: deque(), False: deque()}
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters[True]) + len(self._waiters[False])
+
+    def _busy(self) -> HTTPException:
+        return HTTPException(
+            status_code=503,
+            detail="Analysis service is busy. Please try again in a moment.",
+            headers={"Retry-After": "2"},
+        )
+
+    def _admit(self, signed_in: bool) -> asyncio.Future | None:
+        """Take a free slot (returns None) or join the queue (returns the future that resolves
+        when a slot is handed over)."""
+        if self.in_flight < self.max_in_flight and not self.waiting:
+            self.in_flight += 1
+            return None
+        if self.waiting >= (self.max_queue if signed_in else self.max_guest_queue):
+            if not (signed_in and self._waiters[False]):
+                runtime_stats["model_gate_shed_users" if signed_in else "model_gate_shed_guests"] += 1
+                raise self._busy()
+            self._waiters[False].pop().set_exception(self._busy())
+            runtime_stats["model_gate_shed_guests"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[signed_in].append(future)
+        return future
+
+    def _release(self) -> None:
+        for signed_in in (True, False):
+            queue = self._waiters[signed_in]
+            while queue:
+                future = queue.popleft()
+                if not future.done():
+                    future.set_result(None)  # the slot passes straight to this waiter
+                    return
+        self.in_flight -= 1
+
+    @asynccontextmanager
+    async def slot(self, timeout: float | None = None):
+        signed_in = caller_signed_in.get()
+        future = self._admit(signed_in)
+        if future is not None:
+            try:
+                await asyncio.wait_for(future, timeout=timeout)
+            except BaseException:
+                if future.done() and not future.cancelled() and future.exception() is None:
+                    self._release()  # handed a slot just as we gave up
+                elif future in self._waiters[signed_in]:
+                    self._waiters[signed_in].remove(future)
+                raise
+        try:
+            yield
+        finally:
+            self._release()
+
+
+model_gate = ModelGate(MODEL_MAX_IN_FLIGHT, MODEL_MAX_QUEUE, MODEL_GUEST_MAX_QUEUE)
+
+
+async def generate_content(contents: list, config: "types.GenerateContentConfig", model: str | None = None):
+    """Run a Gemini call on the async client behind the gate, with a per-request deadline
+    that covers both queueing and generation."""
+
+    async def _call():
+        queued = time.perf_counter()
+        async with model_gate.slot():
+            record_stage("model_queue", time.perf_counter() - queued)
+            response = await get_genai_client().aio.models.generate_content(
+                model=model or model_name,
+                contents=contents,
+                config=config,
+            )
+        record_model_usage(model or model_name, getattr(response, "usage_metadata", None))
+        return response
+
+    try:
+        return await asyncio.wait_for(_call(), timeout=MODEL_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Analysis timed out. Please try again.")
+
+
+async def stream_content(contents: list, config: "types.GenerateContentConfig"):
+    """Streaming counterpart of generate_content: yields response text chunks as they arrive,
+    holding one gate slot for the whole stream under the same overall deadline."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + MODEL_TIMEOUT_SECONDS
+
+    def remaining() -> float:
+        return max(0.0, deadline - loop.time())
+
+    usage = None
+    try:
+        queued = time.perf_counter()
+        async with model_gate.slot(timeout=remaining()):
+            record_stage("model_queue", time.perf_counter() - queued)
+            stream = await asyncio.wait_for(
+                get_genai_client().aio.models.generate_content_stream(
+                    model=model_name,
+                    contents=contents,
+                    config=config,
+                ),
+                timeout=remaining(),
+            )
+            chunks = stream.__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), timeout=remaining())
+                except StopAsyncIteration:
+                    break
+                usage = getattr(chunk, "usage_metadata", None) or usage
+                if chunk.text:
+                    yield chunk.text
+            record_model_usage(model_name, usage)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Analysis timed out. Please try again.")
+
+
+_http_client: httpx.AsyncClient | None = None
+_http_client_loop: asyncio.AbstractEventLoop | None = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Instance-lifetime HTTP client so outbound lookups reuse pooled keep-alive connections.
+    Rebuilt if the runtime hands us a different event loop, since pooled sockets are loop-bound."""
+    global _http_client, _http_client_loop
+    loop = asyncio.get_running_loop()
+    if _http_client is None or _http_client.is_closed or _http_client_loop is not loop:
+        _http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(5.0, connect=2.0),
+            limits=httpx.Limits(max_connections=16, max_keepalive_connections=8, keepalive_expiry=60.0),
+        )
+        _http_client_loop = loop
+    return _http_client
+
+
+class YouTubeDiskCache:
+    """SQLite-backed second tier for query -> video id lookups that survives restarts.
+    An empty video id marks a query that returned no results (negative entry)."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            _ensure_local_store_dir()
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS youtube_cache ("
+                "query TEXT PRIMARY KEY, video_id TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+        return self._conn
+
+    def get(self, query: str) -> tuple[str, float] | None:
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT video_id, expires_at FROM youtube_cache WHERE query = ?", (query,)
+            ).fetchone()
+        if row is None or row[1] <= time.time():
+            return None
+        return row[0], row[1]
+
+    def set(self, query: str, video_id: str, ttl: float) -> None:
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO youtube_cache (query, video_id, expires_at) VALUES (?, ?, ?)",
+                (query, video_id, time.time() + ttl),
+            )
+            conn.commit()
+
+
+_background_tasks: set = set()
+
+
+def _discard_background_task(task: asyncio.Task) -> None:
+    _background_tasks.discard(task)
+    if not task.cancelled():
+        task.exception()
+
+
+youtube_cache = TTLCache(YOUTUBE_CACHE_SIZE, YOUTUBE_CACHE_TTL_SECONDS)
+youtube_disk_cache = YouTubeDiskCache(LOCAL_DATA_DIR / "youtube_cache.sqlite3") if YOUTUBE_CACHE_DISK else None
+
+
+def _normalize_youtube_query(query: str) -> str:
+    return " ".join(query.lower().replace('"', " ").replace("'", " ").split())
+
+
+async def _store_youtube_video_id(key: str, video_id: str | None) -> None:
+    ttl = YOUTUBE_CACHE_TTL_SECONDS if video_id else YOUTUBE_CACHE_NEGATIVE_TTL_SECONDS
+    youtube_cache.set(key, video_id or "", ttl=ttl)
+    if youtube_disk_cache is not None:
+        try:
+            await asyncio.to_thread(youtube_disk_cache.set, key, video_id or "", ttl)
+        except sqlite3.Error as e:
+            logger.warning(f"Could not persist YouTube cache entry: {e}")
+
+
+async def _lookup_youtube_video_id(query: str) -> str | None:
+    key = _normalize_youtube_query(query)
+    cached = youtube_cache.get(key, _MISSING)
+    if cached is not _MISSING:
+        runtime_stats["youtube_cache_memory_hits" if cached else "youtube_cache_negative_hits"] += 1
+        return cached or None
+    if youtube_disk_cache is not None:
+        try:
+            row = await asyncio.to_thread(youtube_disk_cache.get, key)
+        except sqlite3.Error:
+            row = None
+        if row is not None:
+            video_id, expires_at = row
+            youtube_cache.set(key, video_id, ttl=expires_at - time.time())
+            runtime_stats["youtube_cache_disk_hits" if video_id else "youtube_cache_negative_hits"] += 1
+            return video_id or None
+
+    runtime_stats["youtube_cache_misses"] += 1
+    # Search youtube and extract first valid video ID via regex to bypass unofficial API hurdles
+    r = await get_http_client().get(YOUTUBE_SEARCH_URL, params={"search_query": query})
+    r.raise_for_status()
+    video_ids = re.findall(r"watch\?v=([a-zA-Z0-9_-]{11})", r.text)
+    video_id = video_ids[0] if video_ids else None
+    await _store_youtube_video_id(key, video_id)
+    return video_id
+
+
+async def iter_youtube_enrichment(recipes: list):
+    """Attach YouTube video ids and thumbnails to recipes in place, yielding each recipe as
+    soon as its thumbnail is attached.
+
+    All lookups run concurrently under one overall budget; recipes whose lookup fails or is
+    still pending when it runs out ship without a thumbnail.
+    """
+    lookups = {}
+    for recipe in recipes:
+        query = recipe.get("youtube_query")
+        if query:
+            lookups[asyncio.ensure_future(_lookup_youtube_video_id(query))] = recipe
+    if not lookups:
+        return
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + YOUTUBE_ENRICH_BUDGET_SECONDS
+    pending = set(lookups)
+    try:
+        while pending and loop.time() < deadline:
+            done, pending = await asyncio.wait(
+                pending, timeout=deadline - loop.time(), return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is not None:
+                    continue  # Fail silently for this single recipe, but proceed with rendering
+                vid = task.result()
+                if vid:
+                    recipe = lookups[task]
+                    recipe["youtube_video_id"] = vid
+                    recipe["youtube_thumbnail"] = f"https://i.ytimg.com/vi/{vid}/hqdefault.jpg"
+                    yield recipe
+    finally:
+        for task in pending:
+            # Let slow lookups finish in the background so they still warm the cache.
+            _background_tasks.add(task)
+            task.add_done_callback(_discard_background_task)
+
+
+@timed("youtube")
+async def enrich_with_youtube(recipes: list) -> None:
+    async for _ in iter_youtube_enrichment(recipes):
+        pass
+
+
+def _coerce_number(value):
+    """Accept numbers the model wrote as text, e.g. "320 kcal" or "20 mins"."""
+    if isinstance(value, str):
+        match = re.search(r"-?\d+(?:\.\d+)?", value)
+        return float(match.group()) if match else 0
+    return value
+
+
+def _coerce_whole_number(value):
+    value = _coerce_number(value)
+    return round(value) if isinstance(value, float) else value
+
+
+Number = Annotated[float, BeforeValidator(_coerce_number)]
+WholeNumber = Annotated[int, BeforeValidator(_coerce_whole_number)]
+
+
+class Nutrition(BaseModel):
+    calories_kcal: Number
+    protein_g: Number
+    carbs_g: Number
+    fat_g: Number
+
+
+class Recipe(BaseModel):
+    name: str
+    description: str
+    servings: str
+    ingredients_used: list[str]
+    additional_ingredients: list[str]
+    instructions: list[str]
+    nutrition: Nutrition
+    health_score: WholeNumber
+    health_explanation: str
+    diet_tags: list[str]
+    estimated_time_minutes: WholeNumber
+    youtube_query: str
+
+
+class ModelOutput(BaseModel):
+    """Base for the model's response schemas. ``salvaged`` marks a result recovered from
+    truncated or off-schema output; such results are served but never cached."""
+
+    _salvaged: bool = PrivateAttr(default=False)
+
+    @property
+    def salvaged(self) -> bool:
+        return self._salvaged
+
+    @classmethod
+    def salvage(cls, data: dict) -> "ModelOutput | None":
+        """Best-effort result from repaired output, or None when nothing usable is left.
+        Schemas that do not override this have no partial form, so nothing is salvaged."""
+        return None
+
+
+class RecipeSuggestions(ModelOutput):
+    recipes: list[Recipe]
+    ranking: list[str]
+
+    @classmethod
+    def salvage(cls, data: dict) -> "RecipeSuggestions | None":
+        """Keep every recipe that validates on its own instead of failing the whole response."""
+        recipes = []
+        for item in data.get("recipes") or []:
+            try:
+                recipes.append(Recipe.model_validate(item))
+            except ValidationError:
+                runtime_stats["model_output_recipes_dropped"] += 1
+        if not recipes:
+            return None
+        ranking = [name for name in data.get("ranking") or [] if isinstance(name, str)]
+        return cls(recipes=recipes, ranking=ranking or [recipe.name for recipe in recipes])
+
+
+class IngredientDetection(ModelOutput):
+    detected_ingredients: list[str]
+
+    @classmethod
+    def salvage(cls, data: dict) -> "IngredientDetection | None":
+        items = [item for item in data.get("detected_ingredients") or [] if isinstance(item, str)]
+        return cls(detected_ingredients=items) if items else None
+
+
+DETECTION_PROMPT = """
+    You are NutriSnap AI, an advanced multimodal nutrition and cooking assistant.
+
+    Identify all visible food ingredients in the image using generic names. Ignore non-food items.
+    If uncertain, include the ingredient with a "possible" tag.
+
+    Return ONLY valid JSON in this structure:
+    {"detected_ingredients": []}
+    """
+
+
+RECIPE_INSTRUCTIONS = """
+    You are NutriSnap AI, an advanced nutrition and cooking assistant built to help users create healthy meals from available ingredients.
+
+    Your task is to generate healthy, personalized recipe suggestions from the detected ingredients in the request.
+    Tailor ALL recipes strictly to the user profile & preferences in the request.
 
     Return ONLY valid JSON in this structure:
-    {{
-      "detected_ingredients": [],
+    {
       "recipes": [
-        {{
+        {
           "name": "",
           "description": "",
           "servings": "",
           "ingredients_used": [],
           "additional_ingredients": [],
           "instructions": [],
-          "nutrition": {{
-            "calories_kcal": "",
-            "protein_g": "",
-            "carbs_g": "",
-            "fat_g": ""
-          }},
-          "health_score": "",
+          "nutrition": {
+            "calories_kcal": 0,
+            "protein_g": 0,
+            "carbs_g": 0,
+            "fat_g": 0
+          },
+          "health_score": 0,
           "health_explanation": "",
           "diet_tags": [],
-          "estimated_time_minutes": "",
+          "estimated_time_minutes": 0,
           "youtube_query": ""
-        }}
+        }
       ],
       "ranking": []
-    }}
+    }
 
     Response must be JSON only.
     """
 
 
+def build_prompt(prefs: dict, ingredients: list) -> str:
+    return f"""
+    ### DETECTED INGREDIENTS
+    {json.dumps(ingredients)}
+
+    ### USER PROFILE & PREFERENCES
+    - Health Goal: {prefs['health_goal']}
+    - Diet Type: {prefs['diet_type']}
+    - Allergies / Restrictions: {prefs['allergies']}
+    - Cooking Time Preference: {prefs['cooking_time']}
+    - Cuisine Preferences: {prefs['cuisine_preferences']}
+    - Calorie Target: {prefs['calorie_target']}
+    - Fitness Goal: {prefs['fitness_goal']}
+    """
+
+
+def recipe_generation_config() -> "types.GenerateContentConfig":
+    """Generation config for the recipe stage. The static instructions go in the system
+    instruction, ahead of the per-request prompt.
+
+    They are not registered as explicit cached content: at a few hundred tokens they are
+    well under Gemini's minimum cacheable size, and padding them to qualify would only add
+    billed input tokens to every call.
+    """
+    return types.GenerateContentConfig(
+        system_instruction=RECIPE_INSTRUCTIONS,
+        response_mime_type="application/json",
+        response_schema=RecipeSuggestions,
+    )
+
+
 @app.get("/api/test")
 async def test_connection():
-    if INIT_ERROR:
+    # Reports only on clients already built, so a health check does not pay for their setup.
+    init_error = firebase_app.error or genai_client.error
+    if init_error:
         return {
             "status": "degraded",
             "message": "Backend booted with configuration errors",
-            "detail": INIT_ERROR,
+            "detail": str(init_error),
         }
     return {"status": "ok", "message": "Hello from the Vercel FastAPI backend!"}
 
 
-@app.post("/api/analyze-food")
+async def require_metrics_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Operational endpoints expose per-user counters and internal state, so they answer only
+    to ``Authorization: Bearer $METRICS_TOKEN``. Without a configured token they do not exist."""
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if credentials is None or not hmac.compare_digest(credentials.credentials.encode(), METRICS_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid metrics token", headers={"WWW-Authenticate": "Bearer"})
+
+
+@app.get("/api/cold-start", dependencies=[Depends(require_metrics_token)])
+async def get_cold_start_report():
+    first_request = cold_start_report["first_request"] or {}
+    total_ms = first_request.get("ready_ms", cold_start_report["module_import_ms"])
+    return {**cold_start_report, "target_ms": COLD_START_TARGET_MS, "within_target": total_ms <= COLD_START_TARGET_MS}
+
+
+@app.get("/api/stats", dependencies=[Depends(require_metrics_token)])
+async def get_stats():
+    return {
+        "counters": dict(runtime_stats),
+        "youtube_cache_entries": len(youtube_cache),
+        "analysis_cache_entries": len(analysis_cache),
+        "detection_cache_entries": len(detection_cache),
+        "preferences_cache_entries": len(preferences_cache),
+        "analyses_in_flight": len(analysis_flights),
+        "firestore_breaker_state": firestore_breaker.state,
+        "local_outbox": await asyncio.to_thread(local_store.outbox_depth),
+    }
+
+
+@app.get("/api/metrics", dependencies=[Depends(require_metrics_token)])
+async def get_metrics():
+    """Prometheus text exposition of the runtime counters, latency histograms, token usage,
+    cache hit ratios and gate/breaker state. Per instance, like /api/stats."""
+    lines = ["# HELP nutrisnap_events_total Runtime event counters (see /api/stats).", "# TYPE nutrisnap_events_total counter"]
+    lines += [f'nutrisnap_events_total{{event="{_escape_label(event)}"}} {count}' for event, count in sorted(runtime_stats.items())]
+    lines += ["# HELP nutrisnap_model_tokens_total Gemini tokens by model and kind.", "# TYPE nutrisnap_model_tokens_total counter"]
+    lines += [
+        f'nutrisnap_model_tokens_total{{model="{_escape_label(model)}",kind="{kind}"}} {count}'
+        for (model, kind), count in sorted(model_tokens.items())
+    ]
+    lines += ["# HELP nutrisnap_cache_hit_ratio Share of lookups served from each cache.", "# TYPE nutrisnap_cache_hit_ratio gauge"]
+    for cache, (hit_keys, miss_keys) in CACHE_HIT_COUNTERS.items():
+        hits = sum(runtime_stats[key] for key in hit_keys)
+        lookups = hits + sum(runtime_stats[key] for key in miss_keys)
+        if lookups:
+            lines.append(f'nutrisnap_cache_hit_ratio{{cache="{cache}"}} {hits / lookups:.4f}')
+    cache_sizes = {
+        "youtube": len(youtube_cache),
+        "analysis": len(analysis_cache),
+        "detection": len(detection_cache),
+        "preferences": len(preferences_cache),
+    }
+    lines += ["# HELP nutrisnap_cache_entries Entries held by each in-process cache.", "# TYPE nutrisnap_cache_entries gauge"]
+    lines += [f'nutrisnap_cache_entries{{cache="{cache}"}} {size}' for cache, size in cache_sizes.items()]
+    lines += [
+        "# HELP nutrisnap_model_in_flight Gemini calls currently running.",
+        "# TYPE nutrisnap_model_in_flight gauge",
+        f"nutrisnap_model_in_flight {model_gate.in_flight}",
+        "# HELP nutrisnap_model_waiting Gemini calls queued for a gate slot.",
+        "# TYPE nutrisnap_model_waiting gauge",
+        f"nutrisnap_model_waiting {model_gate.waiting}",
+        "# HELP nutrisnap_analyses_in_flight Distinct analyses running; duplicate submissions join these.",
+        "# TYPE nutrisnap_analyses_in_flight gauge",
+        f"nutrisnap_analyses_in_flight {len(analysis_flights)}",
+        "# HELP nutrisnap_firestore_breaker_open 1 while the Firestore circuit breaker is open or half-open.",
+        "# TYPE nutrisnap_firestore_breaker_open gauge",
+        f"nutrisnap_firestore_breaker_open {int(firestore_breaker.state != 'closed')}",
+        "# HELP nutrisnap_local_outbox_rows Local writes waiting for replay to Firestore, and dead-lettered ones.",
+        "# TYPE nutrisnap_local_outbox_rows gauge",
+    ]
+    lines += [f'nutrisnap_local_outbox_rows{{state="{state}"}} {count}' for state, count in (await asyncio.to_thread(local_store.outbox_depth)).items()]
+    lines += request_duration.render()
+    lines += stage_duration.render()
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+
+class _Flight:
+    def __init__(self, key, task: asyncio.Task):
+        self.key = key
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key: the first caller starts the work in its own
+    task and later callers await that task, so all of them get its result or its exception.
+    The work is cancelled once every caller waiting on it has gone away.
+
+    The work queues at the model gate with its leader's priority, so a signed-in caller only
+    joins work led by another signed-in caller; guests may join either."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._flights: dict = {}
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    def _forget(self, flight: _Flight) -> None:
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    async def run(self, key, work):
+        """Await ``work()`` (a coroutine function), sharing a call already in flight for ``key``."""
+        signed_in = caller_signed_in.get()
+        flight = self._flights.get((key, True)) or (None if signed_in else self._flights.get((key, False)))
+        leader = flight is None
+        if leader:
+            flight_key = (key, signed_in)
+            flight = self._flights[flight_key] = _Flight(flight_key, asyncio.create_task(work()))
+            flight.task.add_done_callback(lambda _: self._forget(flight))
+        else:
+            runtime_stats[f"{self.name}_coalesced"] += 1
+        flight.waiters += 1
+        started = time.perf_counter()
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if not flight.waiters and not flight.task.done():
+                self._forget(flight)
+                flight.task.cancel()
+            if not leader:
+                record_stage("coalesced", time.perf_counter() - started)
+
+
+analysis_cache = TTLCache(ANALYSIS_CACHE_SIZE, ANALYSIS_CACHE_TTL_SECONDS)
+detection_cache = TTLCache(DETECTION_CACHE_SIZE, DETECTION_CACHE_TTL_SECONDS)
+# In-flight model work, keyed like the caches above, so duplicate submissions share one call.
+analysis_flights = SingleFlight("analysis")
+detection_flights = SingleFlight("detection")
+
+
+def preferences_fingerprint(prefs: dict) -> str:
+    """Stable digest of the preference fields that build_prompt actually renders."""
+    relevant = {key: prefs.get(key) for key in DEFAULT_PREFERENCES}
+    return hashlib.sha256(json.dumps(relevant, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _perceptual_hash(file_bytes: bytes) -> str | None:
+    """64-bit difference hash, stable across re-encoding and resizing of the same photo."""
+    try:
+        with Image.open(io.BytesIO(file_bytes)) as img:
+            small = ImageOps.exif_transpose(img).convert("L").resize((9, 8), Image.Resampling.LANCZOS)
+    except Exception:
+        return None
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return f"{bits:016x}"
+
+
+@timed("hash")
+async def image_analysis_id(file_bytes: bytes) -> str:
+    """Content-addressed id for an uploaded photo, used as the detection cache key."""
+    if ANALYSIS_CACHE_PERCEPTUAL and Image is not None:
+        phash = await asyncio.to_thread(_perceptual_hash, file_bytes)
+        if phash:
+            return f"p{phash}"
+    return hashlib.sha256(file_bytes).hexdigest()
+
+
+def analysis_cache_key(analysis_id: str, prefs: dict) -> str:
+    return f"{analysis_id}:{preferences_fingerprint(prefs)}"
+
+
+def _strip_code_fences(text: str) -> str:
+    response_text = text.strip()
+    if response_text.startswith("```"):
+        response_text = response_text.split("```")[1]
+        if response_text.startswith("json"):
+            response_text = response_text[4:]
+    return response_text
+
+
+def repair_truncated_json(text: str):
+    """Best-effort recovery of a JSON document that was cut off: drop the trailing
+    incomplete value and close whatever containers are still open. Returns None if
+    nothing parses."""
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+    closers = []
+    cut_points = []
+    in_string = False
+    escaped = False
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "[{":
+            closers.append("]" if ch == "[" else "}")
+        elif ch in "]}":
+            if not closers:
+                break
+            closers.pop()
+            cut_points.append((i + 1, "".join(reversed(closers))))
+        elif ch == ",":
+            cut_points.append((i, "".join(reversed(closers))))
+    if in_string:
+        # Cut inside a string: close it (dropping a dangling escape) before the containers.
+        cut_points.append((len(text) - 1 if escaped else len(text), '"' + "".join(reversed(closers))))
+    else:
+        cut_points.append((len(text.rstrip().rstrip(",")), "".join(reversed(closers))))
+    for end, suffix in reversed(cut_points):
+        try:
+            return json.loads(text[:end] + suffix)
+        except json.JSONDecodeError:
+            continue
+    return None
+
+
+def parse_model_text(text: str, schema: type[ModelOutput]):
+    text = _strip_code_fences(text)
+    try:
+        return schema.model_validate_json(text)
+    except ValidationError:
+        pass
+    runtime_stats["model_output_repairs"] += 1
+    data = repair_truncated_json(text)
+    result = schema.salvage(data) if isinstance(data, dict) else None
+    if result is None:
+        raise HTTPException(status_code=502, detail="The model returned an unreadable response. Please try again.")
+    result._salvaged = True
+    return result
+
+
+def parse_model_output(response, schema: type[ModelOutput]):
+    """Typed result of a schema-constrained call. Truncated or slightly off-schema output
+    goes through a cheap repair path instead of failing the request."""
+    if isinstance(response.parsed, schema):
+        return response.parsed
+    return parse_model_text(response.text or "", schema)
+
+
+def check_detected_ingredients(ingredients: list) -> None:
+    if len(ingredients) < 2:
+        raise HTTPException(
+            status_code=400,
+            detail="Not enough ingredients detected. Please try a clearer picture with more visible food items.",
+        )
+
+
+def _json_value_end(text: str, start: int) -> int | None:
+    """Index just past the JSON object/array opening at text[start], or None if it is
+    not complete yet."""
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "[{":
+            depth += 1
+        elif ch in "]}":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    return None
+
+
+class StreamingRecipeParser:
+    """Pulls each recipe object out of a partially streamed generation as soon as it closes."""
+
+    def __init__(self):
+        self.text = ""
+        self.recipes: list = []
+        self._recipes_pos: int | None = None
+
+    def feed(self, chunk: str) -> list[tuple[str, object]]:
+        self.text += chunk
+        events = []
+        if self._recipes_pos is None:
+            match = re.search(r'"recipes"\s*:\s*\[', self.text)
+            if match:
+                self._recipes_pos = match.end()
+        while self._recipes_pos is not None:
+            start = self._recipes_pos
+            while start < len(self.text) and self.text[start] in " \t\r\n,":
+                start += 1
+            if start >= len(self.text) or self.text[start] != "{":
+                break
+            end = _json_value_end(self.text, start)
+            if end is None:
+                break
+            self._recipes_pos = end
+            try:
+                recipe = Recipe.model_validate_json(self.text[start:end]).model_dump()
+            except ValidationError:
+                continue
+            self.recipes.append(recipe)
+            events.append(("recipe", {"index": len(self.recipes) - 1, "recipe": recipe}))
+        return events
+
+
+_image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image-preprocess")
+
+
+def _downscale_image(file_bytes: bytes) -> tuple[bytes, str] | None:
+    """Decode, apply EXIF orientation, fit within IMAGE_MAX_EDGE and re-encode.
+    Returns None if the image can't be decoded or re-encoding wouldn't make it smaller."""
+    out_format = "WEBP" if IMAGE_FORMAT == "webp" else "JPEG"
+    try:
+        with Image.open(io.BytesIO(file_bytes)) as img:
+            # Let the JPEG decoder scale down by DCT while decoding instead of after.
+            img.draft("RGB", (IMAGE_MAX_EDGE, IMAGE_MAX_EDGE))
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE), Image.Resampling.LANCZOS)
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            buffer = io.BytesIO()
+            img.save(buffer, format=out_format, quality=IMAGE_QUALITY, optimize=out_format == "JPEG")
+    except Exception:
+        return None
+    encoded = buffer.getvalue()
+    if len(encoded) >= len(file_bytes):
+        return None
+    return encoded, f"image/{out_format.lower()}"
+
+
+@timed("preprocess")
+async def preprocess_image(file_bytes: bytes, mime_type: str) -> tuple[bytes, str]:
+    """Shrink an upload before it is sent to the model; falls back to the original bytes."""
+    runtime_stats["image_bytes_in"] += len(file_bytes)
+    result = None
+    if Image is not None:
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(_image_executor, _downscale_image, file_bytes)
+    if result is None:
+        runtime_stats["images_passed_through"] += 1
+        runtime_stats["image_bytes_out"] += len(file_bytes)
+        return file_bytes, mime_type
+    runtime_stats["images_downscaled"] += 1
+    runtime_stats["image_bytes_out"] += len(result[0])
+    return result
+
+
+async def _run_detection(analysis_id: str, file_bytes: bytes, mime_type: str) -> list:
+    image_bytes, mime_type = await preprocess_image(file_bytes, mime_type)
+    image_part = types.Part.from_bytes(data=image_bytes, mime_type=mime_type)
+    with stage("detect"):
+        response = await generate_content(
+            contents=[image_part, DETECTION_PROMPT],
+            config=types.GenerateContentConfig(
+                response_mime_type="application/json",
+                response_schema=IngredientDetection,
+                thinking_config=types.ThinkingConfig(thinking_budget=0),
+            ),
+            model=DETECTION_MODEL,
+        )
+    with stage("parse"):
+        detection = parse_model_output(response, IngredientDetection)
+    # Only cache detections that are complete and usable, so a retry gets a fresh model call.
+    check_detected_ingredients(detection.detected_ingredients)
+    if not detection.salvaged:
+        detection_cache.set(analysis_id, detection.detected_ingredients)
+    return detection.detected_ingredients
+
+
+async def detect_ingredients(analysis_id: str, file_bytes: bytes, mime_type: str) -> list:
+    """Stage 1: vision-only ingredient detection, cached per image. Concurrent detections of
+    the same image share one call."""
+    ingredients = detection_cache.get(analysis_id)
+    if ingredients is None:
+        runtime_stats["detection_cache_misses"] += 1
+        ingredients = await detection_flights.run(analysis_id, lambda: _run_detection(analysis_id, file_bytes, mime_type))
+    else:
+        runtime_stats["detection_cache_hits"] += 1
+    check_detected_ingredients(ingredients)
+    return ingredients
+
+
+def build_analysis_result(analysis_id: str, ingredients: list, generated: RecipeSuggestions) -> dict:
+    result = {
+        "analysis_id": analysis_id,
+        "detected_ingredients": ingredients,
+        **generated.model_dump(),
+    }
+    if generated.salvaged:
+        result["partial"] = True  # recovered from cut-off output: served, never cached
+    return result
+
+
+async def generate_recipes(analysis_id: str, ingredients: list, prefs: dict) -> dict:
+    """Stage 2: text-only personalized recipe generation from detected ingredients."""
+    with stage("generate"):
+        response = await generate_content(contents=[build_prompt(prefs, ingredients)], config=recipe_generation_config())
+    with stage("parse"):
+        generated = parse_model_output(response, RecipeSuggestions)
+    return build_analysis_result(analysis_id, ingredients, generated)
+
+
+async def run_analysis(analysis_id: str, file_bytes: bytes, mime_type: str, prefs: dict) -> dict:
+    ingredients = await detect_ingredients(analysis_id, file_bytes, mime_type)
+    return await generate_recipes(analysis_id, ingredients, prefs)
+
+
+def _food_history_entry(recipe_data: dict, prefs: dict) -> dict:
+    return {
+        "analysis_id": recipe_data.get("analysis_id"),
+        "detected_ingredients": recipe_data.get("detected_ingredients", []),
+        "recipes_generated": [r["name"] for r in recipe_data.get("recipes", [])],
+        "preferences_used": prefs,
+    }
+
+
+def _feedback_entry(recipe_name, feedback_type) -> dict:
+    return {"recipe_name": recipe_name, "feedback_type": feedback_type}
+
+
+@timed("history")
+async def save_food_history_batch(uid: str, results: list[dict], prefs: dict) -> None:
+    """Record analyses in the user's food history (through the write-behind queue when enabled)."""
+    try:
+        await write_behind.submit([("food_history", uid, _food_history_entry(recipe_data, prefs)) for recipe_data in results])
+    except Exception as e:
+        logger.warning(f"Could not save food history: {e}")
+
+
+async def save_food_history(uid: str, recipe_data: dict, prefs: dict) -> None:
+    await save_food_history_batch(uid, [recipe_data], prefs)
+
+
+async def analyze_image(file_bytes: bytes, mime_type: str, prefs: dict) -> dict:
+    """Full analysis of one photo: cached result or detection + generation, then YouTube
+    enrichment. Does not touch food history."""
+    analysis_id = await image_analysis_id(file_bytes)
+    cache_key = analysis_cache_key(analysis_id, prefs)
+    recipe_data = analysis_cache.get(cache_key)
+    if recipe_data is None:
+        runtime_stats["analysis_cache_misses"] += 1
+        # Identical uploads in flight at once (retries, double submits) share one analysis;
+        # each caller gets its own copy to enrich and return.
+        recipe_data = copy.deepcopy(
+            await analysis_flights.run(cache_key, lambda: run_analysis(analysis_id, file_bytes, mime_type, prefs))
+        )
+    else:
+        runtime_stats["analysis_cache_hits"] += 1
+        recipe_data = copy.deepcopy(recipe_data)
+
+    # Append true YouTube thumbnails and video IDs before sending to frontend
+    await enrich_with_youtube([r for r in recipe_data.get("recipes", []) if not r.get("youtube_video_id")])
+    if not recipe_data.get("partial"):
+        analysis_cache.set(cache_key, copy.deepcopy(recipe_data))
+    return recipe_data
+
+
+@app.post("/api/analyze-food", dependencies=[Depends(limit_model_calls)])
 async def analyze_food(
     image: UploadFile = File(...),
     uid: str | None = Depends(get_current_user),
-    _: None = Depends(ensure_runtime_ready),
 ):
     try:
-        prefs = get_user_preferences(uid)
+        prefs = await get_user_preferences(uid)
 
         file_bytes = await image.read()
-        image_part = types.Part.from_bytes(data=file_bytes, mime_type=image.content_type)
 
-        prompt = build_prompt(prefs)
+        recipe_data = await analyze_image(file_bytes, image.content_type, prefs)
 
-        response = client.models.generate_content(
-            model=model_name,
-            contents=[image_part, prompt],
-            config=types.GenerateContentConfig(
-                response_mime_type="application/json",
-            ),
-        )
+        if uid:
+            await save_food_history(uid, recipe_data, prefs)
+
+        return recipe_data
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Analysis failed")
+        raise HTTPException(status_code=500, detail=str(e))
 
-        response_text = response.text.strip()
-        if response_text.startswith("```"):
-            response_text = response_text.split("```")[1]
-            if response_text.startswith("json"):
-                response_text = response_text[4:]
 
-        recipe_data = json.loads(response_text)
-        
-        # Append true YouTube thumbnails and video IDs before sending to frontend
-        for recipe in recipe_data.get("recipes", []):
+@app.post("/api/analyze-food/batch")
+async def analyze_food_batch(
+    request: Request,
+    images: list[UploadFile] = File(...),
+    uid: str | None = Depends(get_current_user),
+):
+    """Analyze several photos in one request. Preferences are fetched once, images are
+    analyzed concurrently (at most BATCH_CONCURRENCY at a time), each image reports its own
+    result or error, and food history is committed in a single batched write. Each image
+    costs one token from the caller's model budget."""
+    if len(images) > BATCH_MAX_IMAGES:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_IMAGES} images can be analyzed per request.")
+    await enforce_rate_limit(request, "model", uid, cost=len(images))
+
+    prefs = await get_user_preferences(uid)
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def analyze_one(upload: UploadFile) -> dict:
+        async with semaphore:
             try:
-                query = recipe.get("youtube_query")
-                if query:
-                    # Search youtube and extract first valid video ID via regex to bypass unofficial API hurdles
-                    r = httpx.get(f"https://www.youtube.com/results?search_query={query.replace(' ', '+')}", timeout=5.0)
-                    video_ids = re.findall(r"watch\?v=([a-zA-Z0-9_-]{11})", r.text)
-                    if video_ids:
-                        vid = video_ids[0]
-                        recipe["youtube_video_id"] = vid
-                        recipe["youtube_thumbnail"] = f"https://i.ytimg.com/vi/{vid}/hqdefault.jpg"
+                file_bytes = await upload.read()
+                result = await analyze_image(file_bytes, upload.content_type, prefs)
+                return {"filename": upload.filename, "ok": True, "result": result}
+            except HTTPException as e:
+                return {"filename": upload.filename, "ok": False, "error": {"status": e.status_code, "detail": e.detail}}
             except Exception as e:
-                pass # Fail silently for this single recipe, but proceed with rendering
+                logger.exception(f"Analysis of {upload.filename} failed")
+                return {"filename": upload.filename, "ok": False, "error": {"status": 500, "detail": str(e)}}
+
+    items = await asyncio.gather(*(analyze_one(upload) for upload in images))
+    succeeded = [item["result"] for item in items if item["ok"]]
+
+    if uid and succeeded:
+        await save_food_history_batch(uid, succeeded, prefs)
+
+    merged_ingredients = list(dict.fromkeys(
+        ingredient for result in succeeded for ingredient in result.get("detected_ingredients", [])
+    ))
+    return {"results": items, "merged_ingredients": merged_ingredients}
+
+
+def _sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream_analysis(analysis_id: str, file_bytes: bytes, mime_type: str, prefs: dict, progress: asyncio.Queue) -> dict:
+    """run_analysis with streamed generation, putting (event, data) pairs on ``progress`` as
+    ingredients and recipes become available. It runs as an analysis_flights entry, so
+    identical analyses submitted while it streams wait for its result instead of a new call."""
+    ingredients = await detect_ingredients(analysis_id, file_bytes, mime_type)
+    progress.put_nowait(("ingredients", ingredients))
+    parser = StreamingRecipeParser()
+    async for text in stream_content(
+        contents=[build_prompt(prefs, ingredients)],
+        config=recipe_generation_config(),
+    ):
+        for event in parser.feed(text):
+            progress.put_nowait(event)
+    recipe_data = build_analysis_result(analysis_id, ingredients, parse_model_text(parser.text, RecipeSuggestions))
+    for index, recipe in enumerate(recipe_data["recipes"][len(parser.recipes):], start=len(parser.recipes)):
+        progress.put_nowait(("recipe", {"index": index, "recipe": recipe}))
+    return recipe_data
+
+
+@app.post("/api/analyze-food/stream", dependencies=[Depends(limit_model_calls)])
+async def analyze_food_stream(
+    image: UploadFile = File(...),
+    uid: str | None = Depends(get_current_user),
+):
+    """Server-Sent Events variant of /api/analyze-food.
+
+    Emits `ingredients` as soon as detection finishes, one `recipe` event per recipe as
+    it completes, `thumbnail` patches as YouTube lookups land, then `done` with the full
+    result. Failures after the stream has started are reported as an `error` event.
+    """
+    prefs = await get_user_preferences(uid)
+    file_bytes = await image.read()
+    mime_type = image.content_type
+    analysis_id = await image_analysis_id(file_bytes)
+    cache_key = analysis_cache_key(analysis_id, prefs)
+
+    async def events():
+        try:
+            cached = analysis_cache.get(cache_key)
+            replay = cached is not None
+            if cached is not None:
+                runtime_stats["analysis_cache_hits"] += 1
+                recipe_data = copy.deepcopy(cached)
+            else:
+                runtime_stats["analysis_cache_misses"] += 1
+                progress: asyncio.Queue = asyncio.Queue()
+                flight = asyncio.create_task(analysis_flights.run(
+                    cache_key, lambda: stream_analysis(analysis_id, file_bytes, mime_type, prefs, progress)
+                ))
+                # Ends the loop below once the flight settles, including when this stream joined an
+                # analysis already in flight and so gets no progress events of its own.
+                flight.add_done_callback(lambda _: progress.put_nowait(None))
+                try:
+                    replay = True
+                    while (item := await progress.get()) is not None:
+                        replay = False
+                        yield _sse_event(*item)
+                    recipe_data = copy.deepcopy(await flight)
+                finally:
+                    flight.cancel()
+            if replay:
+                yield _sse_event("ingredients", recipe_data.get("detected_ingredients", []))
+                for index, recipe in enumerate(recipe_data.get("recipes", [])):
+                    yield _sse_event("recipe", {"index": index, "recipe": recipe})
+
+            recipes = recipe_data.get("recipes", [])
+            positions = {id(recipe): index for index, recipe in enumerate(recipes)}
+            async for recipe in iter_youtube_enrichment([r for r in recipes if not r.get("youtube_video_id")]):
+                yield _sse_event("thumbnail", {
+                    "index": positions[id(recipe)],
+                    "youtube_video_id": recipe["youtube_video_id"],
+                    "youtube_thumbnail": recipe["youtube_thumbnail"],
+                })
+            if not recipe_data.get("partial"):
+                analysis_cache.set(cache_key, copy.deepcopy(recipe_data))
+
+            if uid:
+                await save_food_history(uid, recipe_data, prefs)
+
+            yield _sse_event("done", recipe_data)
+        except HTTPException as e:
+            yield _sse_event("error", {"status": e.status_code, "detail": e.detail})
+        except Exception as e:
+            logger.exception("Streamed analysis failed")
+            yield _sse_event("error", {"status": 500, "detail": str(e)})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def _find_history_ingredients(uid: str, analysis_id: str) -> list | None:
+    """Recover detected ingredients for an analysis from the user's food history."""
+    try:
+        entry = await user_repository.find_food_history(uid, analysis_id)
+    except Exception as e:
+        logger.warning(f"Could not look up analysis {analysis_id}: {e}")
+        return None
+    return entry.get("detected_ingredients") if entry else None
 
-        ingredients = recipe_data.get("detected_ingredients", [])
-        if len(ingredients) < 2:
-            raise HTTPException(
-                status_code=400,
-                detail="Not enough ingredients detected. Please try a clearer picture with more visible food items.",
-            )
+
+@app.post("/api/analyses/{analysis_id}/regenerate", dependencies=[Depends(limit_model_calls)])
+async def regenerate_recipes(
+    analysis_id: str,
+    uid: str | None = Depends(get_current_user),
+):
+    """Generate fresh recipes for a previously analyzed photo using the caller's current
+    preferences, without re-sending the image."""
+    try:
+        prefs = await get_user_preferences(uid)
+        ingredients = detection_cache.get(analysis_id)
+        if ingredients is None and uid:
+            ingredients = await _find_history_ingredients(uid, analysis_id)
+            if ingredients is not None:
+                detection_cache.set(analysis_id, ingredients)
+        if ingredients is None:
+            raise HTTPException(status_code=404, detail="This analysis has expired. Please upload the photo again.")
+        check_detected_ingredients(ingredients)
+
+        recipe_data = await generate_recipes(analysis_id, ingredients, prefs)
+        await enrich_with_youtube(recipe_data["recipes"])
+        if not recipe_data.get("partial"):
+            analysis_cache.set(analysis_cache_key(analysis_id, prefs), copy.deepcopy(recipe_data))
 
         if uid:
-            try:
-                from google.cloud.firestore import SERVER_TIMESTAMP
-
-                history_entry = {
-                    "detected_ingredients": ingredients,
-                    "recipes_generated": [r["name"] for r in recipe_data.get("recipes", [])],
-                    "analyzed_at": SERVER_TIMESTAMP,
-                    "preferences_used": prefs,
-                }
-                db.collection("users").document(uid).collection("food_history").document().set(history_entry)
-            except Exception as e:
-                if _is_firestore_unavailable(e):
-                    local = _read_user_store(uid)
-                    history_entry = {
-                        "id": str(uuid4()),
-                        "detected_ingredients": ingredients,
-                        "recipes_generated": [r["name"] for r in recipe_data.get("recipes", [])],
-                        "analyzed_at": _now_iso(),
-                        "preferences_used": prefs,
-                    }
-                    local["food_history"] = [history_entry, *(local.get("food_history") or [])][:50]
-                    _write_user_store(uid, local)
-                else:
-                    print(f"Could not save food history: {e}")
+            await save_food_history(uid, recipe_data, prefs)
 
         return recipe_data
 
     except HTTPException:
         raise
     except Exception as e:
+        logger.exception("Recipe regeneration failed")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/api/bootstrap")
+async def bootstrap(limit: int = Query(BOOTSTRAP_PAGE_LIMIT, ge=1, le=PAGE_MAX_LIMIT), uid: str = Depends(require_user)):
+    """Everything the signed-in app shell loads: profile, preferences and the first page of
+    saved-recipe and history summaries, read concurrently under one token check."""
+    user, (saved, saved_cursor), (history, history_cursor) = await asyncio.gather(
+        user_repository.get_user(uid),
+        user_repository.list_page("saved_recipes", uid, limit, None, SAVED_RECIPE_SUMMARY_FIELDS),
+        user_repository.list_page("food_history", uid, limit, None, FOOD_HISTORY_SUMMARY_FIELDS),
+    )
+    user = user or {}
+    prefs = {**DEFAULT_PREFERENCES, **(user.get("preferences") or {})}
+    # The profile read already has the preferences, so the first analysis needs no extra read.
+    await _set_cached_preferences(uid, prefs, replace=False)
+    return {
+        "uid": uid,
+        "profile": user.get("profile") or {},
+        "preferences": prefs,
+        "saved_recipes": {"items": saved, "next_cursor": saved_cursor},
+        "food_history": {"items": history, "next_cursor": history_cursor},
+    }
+
+
 @app.get("/api/profile")
-async def get_profile(uid: str = Depends(require_user), _: None = Depends(ensure_runtime_ready)):
-    try:
-        doc = db.collection("users").document(uid).get()
-        if not doc.exists:
-            return {"uid": uid, "profile": {}, "preferences": DEFAULT_PREFERENCES}
-        return doc.to_dict()
-    except Exception as e:
-        if _is_firestore_unavailable(e):
-            local = _read_user_store(uid)
-            return {"uid": uid, "profile": local.get("profile", {}), "preferences": local.get("preferences", DEFAULT_PREFERENCES)}
-        raise
+async def get_profile(uid: str = Depends(require_user)):
+    user = await user_repository.get_user(uid)
+    if user is None:
+        return {"uid": uid, "profile": {}, "preferences": DEFAULT_PREFERENCES}
+    return user
 
 
 @app.put("/api/profile")
-async def update_profile(data: dict, uid: str = Depends(require_user), _: None = Depends(ensure_runtime_ready)):
-    try:
-        db.collection("users").document(uid).set(data, merge=True)
-        return {"message": "Profile updated"}
-    except Exception as e:
-        if _is_firestore_unavailable(e):
-            local = _read_user_store(uid)
-            incoming_profile = data.get("profile", {}) if isinstance(data, dict) else {}
-            local["profile"] = {**(local.get("profile") or {}), **incoming_profile}
-            _write_user_store(uid, local)
-            return {"message": "Profile updated"}
-        raise
+async def update_profile(data: dict, uid: str = Depends(require_user)):
+    await user_repository.update_profile(uid, data)
+    if isinstance(data, dict) and "preferences" in data:
+        # Read back the merged document so the cache holds what the store now has.
+        user = await user_repository.get_user(uid) or {}
+        await _set_cached_preferences(uid, {**DEFAULT_PREFERENCES, **(user.get("preferences") or {})})
+    return {"message": "Profile updated"}
 
 
 @app.get("/api/preferences")
-async def get_preferences(uid: str = Depends(require_user), _: None = Depends(ensure_runtime_ready)):
-    return get_user_preferences(uid)
+async def get_preferences(uid: str = Depends(require_user)):
+    return await get_user_preferences(uid)
 
 
 @app.put("/api/preferences")
-async def update_preferences(prefs: dict, uid: str = Depends(require_user), _: None = Depends(ensure_runtime_ready)):
-    try:
-        db.collection("users").document(uid).set({"preferences": prefs}, merge=True)
-        return {"message": "Preferences updated", "preferences": prefs}
-    except Exception as e:
-        if _is_firestore_unavailable(e):
-            local = _read_user_store(uid)
-            local["preferences"] = {**DEFAULT_PREFERENCES, **(prefs or {})}
-            _write_user_store(uid, local)
-            return {"message": "Preferences updated", "preferences": local["preferences"]}
-        raise
+async def update_preferences(prefs: dict, uid: str = Depends(require_user)):
+    saved = await user_repository.set_preferences(uid, prefs)
+    await _set_cached_preferences(uid, {**DEFAULT_PREFERENCES, **saved})
+    return {"message": "Preferences updated", "preferences": saved}
 
 
 @app.get("/api/saved-recipes")
-async def get_saved_recipes(uid: str = Depends(require_user), _: None = Depends(ensure_runtime_ready)):
-    try:
-        recipes_ref = db.collection("users").document(uid).collection("saved_recipes")
-        docs = recipes_ref.order_by("saved_at", direction=firestore.Query.DESCENDING).stream()
-        return [{"id": doc.id, **doc.to_dict()} for doc in docs]
-    except Exception as e:
-        if _is_firestore_unavailable(e):
-            local = _read_user_store(uid)
-            return local.get("saved_recipes", [])
-        raise
+async def get_saved_recipes(
+    response: Response,
+    limit: int = Query(PAGE_DEFAULT_LIMIT, ge=1, le=PAGE_MAX_LIMIT),
+    after: str | None = None,
+    view: Literal["summary", "full"] = "summary",
+    uid: str = Depends(require_user),
+):
+    fields = SAVED_RECIPE_SUMMARY_FIELDS if view == "summary" else None
+    items, next_cursor = await user_repository.list_page("saved_recipes", uid, limit, after, fields)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return items
+
+
+@app.get("/api/saved-recipes/{recipe_id}")
+async def get_saved_recipe(recipe_id: str, uid: str = Depends(require_user)):
+    recipe = await user_repository.get_entry("saved_recipes", uid, recipe_id)
+    if recipe is None:
+        raise HTTPException(status_code=404, detail="Saved recipe not found.")
+    return recipe
 
 
 @app.post("/api/saved-recipes")
-async def save_recipe(recipe: dict, uid: str = Depends(require_user), _: None = Depends(ensure_runtime_ready)):
-    try:
-        from google.cloud.firestore import SERVER_TIMESTAMP
+async def save_recipe(recipe: dict, uid: str = Depends(require_user)):
+    saved_id = await user_repository.add_saved_recipe(uid, recipe)
+    return {"id": saved_id, "message": "Recipe saved"}
 
-        recipe["saved_at"] = SERVER_TIMESTAMP
-        ref = db.collection("users").document(uid).collection("saved_recipes").document()
-        ref.set(recipe)
-        return {"id": ref.id, "message": "Recipe saved"}
-    except Exception as e:
-        if _is_firestore_unavailable(e):
-            local = _read_user_store(uid)
-            saved_id = str(uuid4())
-            saved_recipe = {**recipe, "id": saved_id, "saved_at": _now_iso()}
-            local["saved_recipes"] = [saved_recipe, *(local.get("saved_recipes") or [])]
-            _write_user_store(uid, local)
-            return {"id": saved_id, "message": "Recipe saved"}
-        raise
+
+@app.post("/api/saved-recipes/batch")
+async def save_recipes(recipes: list[dict], uid: str = Depends(require_user)):
+    if not recipes:
+        raise HTTPException(status_code=400, detail="No recipes provided.")
+    if len(recipes) > SAVE_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {SAVE_BATCH_MAX} recipes can be saved per request.")
+    ids, created = await user_repository.add_saved_recipes(uid, recipes)
+    return {"ids": ids, "saved": created, "message": "Recipes saved"}
 
 
 @app.delete("/api/saved-recipes/{recipe_id}")
-async def delete_saved_recipe(recipe_id: str, uid: str = Depends(require_user), _: None = Depends(ensure_runtime_ready)):
-    try:
-        db.collection("users").document(uid).collection("saved_recipes").document(recipe_id).delete()
-        return {"message": "Recipe deleted"}
-    except Exception as e:
-        if _is_firestore_unavailable(e):
-            local = _read_user_store(uid)
-            local["saved_recipes"] = [
-                item for item in (local.get("saved_recipes") or []) if item.get("id") != recipe_id
-            ]
-            _write_user_store(uid, local)
-            return {"message": "Recipe deleted"}
-        raise
+async def delete_saved_recipe(recipe_id: str, uid: str = Depends(require_user)):
+    await user_repository.delete_saved_recipe(uid, recipe_id)
+    return {"message": "Recipe deleted"}
 
 
 @app.get("/api/food-history")
-async def get_food_history(uid: str = Depends(require_user), _: None = Depends(ensure_runtime_ready)):
-    try:
-        history_ref = db.collection("users").document(uid).collection("food_history")
-        docs = history_ref.order_by("analyzed_at", direction=firestore.Query.DESCENDING).limit(50).stream()
-        return [{"id": doc.id, **doc.to_dict()} for doc in docs]
-    except Exception as e:
-        if _is_firestore_unavailable(e):
-            local = _read_user_store(uid)
-            return (local.get("food_history") or [])[:50]
-        raise
+async def get_food_history(
+    response: Response,
+    limit: int = Query(PAGE_DEFAULT_LIMIT, ge=1, le=PAGE_MAX_LIMIT),
+    after: str | None = None,
+    view: Literal["summary", "full"] = "summary",
+    uid: str = Depends(require_user),
+):
+    fields = FOOD_HISTORY_SUMMARY_FIELDS if view == "summary" else None
+    items, next_cursor = await user_repository.list_page("food_history", uid, limit, after, fields)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return items
+
+
+@app.get("/api/food-history/{entry_id}")
+async def get_food_history_entry(entry_id: str, uid: str = Depends(require_user)):
+    entry = await user_repository.get_entry("food_history", uid, entry_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="History entry not found.")
+    return entry
 
 
 @app.post("/api/feedback")
-async def submit_feedback(payload: dict, uid: str = Depends(require_user), _: None = Depends(ensure_runtime_ready)):
-    feedback_entry = {
-        "recipe_name": payload.get("recipe_name"),
-        "feedback_type": payload.get("feedback_type"),
-        "created_at": _now_iso(),
-    }
-    try:
-        from google.cloud.firestore import SERVER_TIMESTAMP
+async def submit_feedback(payload: dict, uid: str = Depends(require_user)):
+    if payload.get("feedback_type") not in FEEDBACK_TYPES:
+        raise HTTPException(status_code=400, detail=f"feedback_type must be one of: {', '.join(sorted(FEEDBACK_TYPES))}.")
+    await write_behind.submit([("feedback", uid, _feedback_entry(payload.get("recipe_name"), payload.get("feedback_type")))])
+    if not WRITE_BEHIND_ENABLED:
+        # Serverless instances may not live until the next periodic roll-up.
+        await feedback_rollup.run_once()
+    return {"message": "Feedback submitted"}
 
-        firestore_entry = {
-            "recipe_name": payload.get("recipe_name"),
-            "feedback_type": payload.get("feedback_type"),
-            "created_at": SERVER_TIMESTAMP,
-        }
-        db.collection("users").document(uid).collection("feedback").document().set(firestore_entry)
-        return {"message": "Feedback submitted"}
-    except Exception as e:
-        if _is_firestore_unavailable(e):
-            local = _read_user_store(uid)
-            local["feedback"] = [feedback_entry, *(local.get("feedback") or [])][:100]
-            _write_user_store(uid, local)
-            return {"message": "Feedback submitted"}
-        raise
+
+@app.get("/api/feedback/popular", dependencies=[Depends(limit_crud_calls)])
+async def get_popular_recipes(limit: int = Query(10, ge=1, le=POPULAR_RECIPES_MAX_LIMIT)):
+    popular = popular_recipes_cache.get(limit)
+    if popular is None:
+        popular = await user_repository.popular_recipes(limit)
+        popular_recipes_cache.set(limit, popular)
+    return popular
+
+
+cold_start_report["module_import_ms"] = round((time.perf_counter() - _IMPORT_STARTED) * 1000, 1)
+logger.info(f"Cold start: module imported in {cold_start_report['module_import_ms']} ms")
+
+
+if __name__ == "__main__":
+    # Import-time budget check, e.g. in CI: exits non-zero when the import exceeds the target.
+    print(json.dumps(cold_start_report, indent=2))
+    raise SystemExit(0 if cold_start_report["module_import_ms"] <= COLD_START_TARGET_MS else 1)
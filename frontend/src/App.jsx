@@ -27,6 +27,8 @@ function App() {
   const [user, setUser] = useState(null);
   const [showAuthModal, setShowAuthModal] = useState(false);
   const [savedRecipeIds, setSavedRecipeIds] = useState({});
+  // Data loaded once at sign-in by /api/bootstrap; each view uses its part on first open.
+  const [bootstrap, setBootstrap] = useState(null);
 
   const steps = [
     { label: 'Analyzing image data...', icon: '🧠' },
@@ -39,16 +41,20 @@ function App() {
   useEffect(() => {
     const unsubscribe = onAuthStateChanged(auth, async (firebaseUser) => {
       setUser(firebaseUser);
+      setBootstrap(null);
       if (firebaseUser) {
-        // Check if user has completed survey
+        // Load the app shell data and check if user has completed survey
         try {
           const token = await firebaseUser.getIdToken();
           const res = await requestApi({
-            path: 'preferences',
+            path: 'bootstrap',
             headers: { 'Authorization': `Bearer ${token}` }
           });
           if (res.ok) {
-            const prefs = await res.json();
+            const data = await res.json();
+            setBootstrap(data);
+            setSavedRecipeIds(Object.fromEntries(data.saved_recipes.items.map(r => [r.name, r.id])));
+            const prefs = data.preferences;
             // If the user has default preferences (e.g. no cuisine set), or if this is their first login
             // We can decide to show the survey. For now, let's show it if they have no custom cuisine prefs
             if (prefs.cuisine_preferences === 'any' || !prefs.has_onboarded) {
@@ -63,6 +69,10 @@ function App() {
     return () => unsubscribe();
   }, []);
 
+  const consumeBootstrap = (key) => {
+    setBootstrap(prev => prev && { ...prev, [key]: null });
+  };
+
   const getAuthToken = async () => {
     if (!user) return null;
     return await user.getIdToken();
@@ -117,6 +127,7 @@ function App() {
 
       const data = await response.json();
       console.log("Analysis Result:", data);
+      consumeBootstrap('food_history');
       
       // Push progress bar to the absolute finale
       setActiveStep(steps.length - 1);
@@ -148,6 +159,7 @@ function App() {
       return;
     }
     const recipeKey = recipe.name;
+    consumeBootstrap('saved_recipes');
     try {
       const token = await getAuthToken();
       if (savedRecipeIds[recipeKey]) {
@@ -184,6 +196,7 @@ function App() {
   const handleSignOut = async () => {
     await signOut(auth);
     setSavedRecipeIds({});
+    setBootstrap(null);
   };
 
   return (
@@ -269,12 +282,22 @@ function App() {
 
         <section className="content-center">
           {currentView === 'profile' ? (
-            <Profile user={user} />
+            <Profile
+              user={user}
+              prefetched={bootstrap?.profile}
+              onPrefetchedUsed={() => consumeBootstrap('profile')}
+            />
           ) : currentView === 'history' ? (
-            <History user={user} />
+            <History
+              user={user}
+              prefetched={bootstrap?.food_history}
+              onPrefetchedUsed={() => consumeBootstrap('food_history')}
+            />
           ) : currentView === 'saved_recipes' ? (
             <SavedRecipes 
               user={user} 
+              prefetched={bootstrap?.saved_recipes}
+              onPrefetchedUsed={() => consumeBootstrap('saved_recipes')}
               onUnsave={(id) => {
                 const recipeKey = Object.keys(savedRecipeIds).find(key => savedRecipeIds[key] === id);
                 if (recipeKey) {
@@ -347,6 +370,8 @@ function App() {
         isOpen={showPreferences} 
         onClose={() => setShowPreferences(false)} 
         user={user} 
+        prefetched={bootstrap?.preferences}
+        onPrefetchedUsed={() => consumeBootstrap('preferences')}
       />
     </div>
   );
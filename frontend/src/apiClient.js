@@ -2,6 +2,9 @@ const API_BASE_URL =
   import.meta.env.VITE_API_BASE_URL ||
   (import.meta.env.DEV ? `http://${window.location.hostname}:8000` : window.location.origin);
 
+// Index of the URL variant that last reached the API; later requests try it first.
+let preferredCandidate = 0;
+
 const getApiCandidates = (path) => {
   const baseUrl = API_BASE_URL.replace(/\/$/, '');
   const cleanPath = path.replace(/^\/+/, '');
@@ -18,7 +21,10 @@ export const requestApi = async ({ path, method = 'GET', headers = {}, body, sig
   let lastError = null;
   let hit404 = false;
 
-  for (const url of urls) {
+  const order = [preferredCandidate, ...urls.keys()].filter((index, i, all) => all.indexOf(index) === i);
+
+  for (const index of order) {
+    const url = urls[index];
     try {
       response = await fetch(url, {
         method,
@@ -28,6 +34,7 @@ export const requestApi = async ({ path, method = 'GET', headers = {}, body, sig
       });
 
       if (response.status !== 404) {
+        preferredCandidate = index;
         return response;
       }
 
@@ -1,13 +1,20 @@
 import { useState, useEffect } from 'react';
 import { requestApi } from '../apiClient';
 
-export default function History({ user }) {
+export default function History({ user, prefetched, onPrefetchedUsed }) {
   const [history, setHistory] = useState([]);
   const [isLoading, setIsLoading] = useState(true);
   const [error, setError] = useState(null);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [isLoadingMore, setIsLoadingMore] = useState(false);
 
   useEffect(() => {
-    if (user) {
+    if (user && prefetched) {
+      setHistory(prefetched.items);
+      setNextCursor(prefetched.next_cursor);
+      setIsLoading(false);
+      onPrefetchedUsed();
+    } else if (user) {
       fetchHistory();
     } else {
       setIsLoading(false);
@@ -25,6 +32,7 @@ export default function History({ user }) {
       if (res.ok) {
         const data = await res.json();
         setHistory(data);
+        setNextCursor(res.headers.get('X-Next-Cursor'));
       } else {
         setError("Failed to load history.");
       }
@@ -36,6 +44,26 @@ export default function History({ user }) {
     }
   };
 
+  const loadMore = async () => {
+    setIsLoadingMore(true);
+    try {
+      const token = await user.getIdToken();
+      const res = await requestApi({
+        path: `food-history?after=${encodeURIComponent(nextCursor)}`,
+        headers: { 'Authorization': `Bearer ${token}` }
+      });
+      if (res.ok) {
+        const data = await res.json();
+        setHistory(prev => [...prev, ...data]);
+        setNextCursor(res.headers.get('X-Next-Cursor'));
+      }
+    } catch (err) {
+      console.error(err);
+    } finally {
+      setIsLoadingMore(false);
+    }
+  };
+
   if (isLoading) {
     return <div style={{ color: 'var(--text-secondary)', textAlign: 'center', marginTop: '2rem' }}>Loading history...</div>;
   }
@@ -102,6 +130,26 @@ export default function History({ user }) {
           );
         })}
       </div>
+      {nextCursor && (
+        <button
+          onClick={loadMore}
+          disabled={isLoadingMore}
+          style={{
+            display: 'block',
+            margin: '2rem auto 0',
+            background: 'rgba(255,255,255,0.05)',
+            border: 'none',
+            color: 'var(--text-primary)',
+            padding: '10px 24px',
+            borderRadius: '20px',
+            cursor: 'pointer',
+            fontWeight: 600,
+            fontSize: '0.9rem'
+          }}
+        >
+          {isLoadingMore ? 'Loading...' : 'Load more'}
+        </button>
+      )}
     </div>
   );
 }
@@ -1,7 +1,7 @@
 import { useState, useEffect } from 'react';
 import { requestApi } from '../apiClient';
 
-export default function PreferencesSurvey({ isOpen, onClose, user }) {
+export default function PreferencesSurvey({ isOpen, onClose, user, prefetched, onPrefetchedUsed }) {
   const [preferences, setPreferences] = useState({
     health_goal: 'balanced',
     diet_type: 'non-vegetarian',
@@ -18,7 +18,10 @@ export default function PreferencesSurvey({ isOpen, onClose, user }) {
   const [saveStatus, setSaveStatus] = useState(''); // 'saving', 'saved', 'error'
 
   useEffect(() => {
-    if (isOpen && user) {
+    if (isOpen && user && prefetched) {
+      setPreferences(prev => ({ ...prev, ...prefetched }));
+      onPrefetchedUsed();
+    } else if (isOpen && user) {
       fetchPreferences();
     }
   }, [isOpen, user]);
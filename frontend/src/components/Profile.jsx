@@ -1,7 +1,7 @@
 import { useState, useEffect } from 'react';
 import { requestApi } from '../apiClient';
 
-export default function Profile({ user }) {
+export default function Profile({ user, prefetched, onPrefetchedUsed }) {
   const [profile, setProfile] = useState({
     full_name: '',
     age: '',
@@ -14,7 +14,11 @@ export default function Profile({ user }) {
   const [successMsg, setSuccessMsg] = useState('');
 
   useEffect(() => {
-    if (user) {
+    if (user && prefetched) {
+      setProfile(prev => ({ ...prev, ...prefetched }));
+      setIsLoading(false);
+      onPrefetchedUsed();
+    } else if (user) {
       fetchProfile();
     } else {
       setIsLoading(false);
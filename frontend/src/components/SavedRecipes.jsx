@@ -1,13 +1,20 @@
 import { useState, useEffect } from 'react';
 import { requestApi } from '../apiClient';
 
-export default function SavedRecipes({ user, onUnsave }) {
+export default function SavedRecipes({ user, prefetched, onPrefetchedUsed, onUnsave }) {
   const [recipes, setRecipes] = useState([]);
   const [isLoading, setIsLoading] = useState(true);
   const [error, setError] = useState(null);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [isLoadingMore, setIsLoadingMore] = useState(false);
 
   useEffect(() => {
-    if (user) {
+    if (user && prefetched) {
+      setRecipes(prefetched.items);
+      setNextCursor(prefetched.next_cursor);
+      setIsLoading(false);
+      onPrefetchedUsed();
+    } else if (user) {
       fetchSavedRecipes();
     } else {
       setIsLoading(false);
@@ -25,6 +32,7 @@ export default function SavedRecipes({ user, onUnsave }) {
       if (res.ok) {
         const data = await res.json();
         setRecipes(data);
+        setNextCursor(res.headers.get('X-Next-Cursor'));
       } else {
         setError("Failed to load saved recipes.");
       }
@@ -36,6 +44,26 @@ export default function SavedRecipes({ user, onUnsave }) {
     }
   };
 
+  const loadMore = async () => {
+    setIsLoadingMore(true);
+    try {
+      const token = await user.getIdToken();
+      const res = await requestApi({
+        path: `saved-recipes?after=${encodeURIComponent(nextCursor)}`,
+        headers: { 'Authorization': `Bearer ${token}` }
+      });
+      if (res.ok) {
+        const data = await res.json();
+        setRecipes(prev => [...prev, ...data]);
+        setNextCursor(res.headers.get('X-Next-Cursor'));
+      }
+    } catch (err) {
+      console.error(err);
+    } finally {
+      setIsLoadingMore(false);
+    }
+  };
+
   const handleUnsave = async (recipeId) => {
     try {
       const token = await user.getIdToken();
@@ -132,6 +160,26 @@ export default function SavedRecipes({ user, onUnsave }) {
           </div>
         ))}
       </div>
+      {nextCursor && (
+        <button
+          onClick={loadMore}
+          disabled={isLoadingMore}
+          style={{
+            display: 'block',
+            margin: '2rem auto 0',
+            background: 'rgba(255,255,255,0.05)',
+            border: 'none',
+            color: 'var(--text-primary)',
+            padding: '10px 24px',
+            borderRadius: '20px',
+            cursor: 'pointer',
+            fontWeight: 600,
+            fontSize: '0.9rem'
+          }}
+        >
+          {isLoadingMore ? 'Loading...' : 'Load more'}
+        </button>
+      )}
     </div>
   );
 }